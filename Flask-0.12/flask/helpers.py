@@ -14,6 +14,7 @@ import sys
 import pkgutil
 import posixpath
 import mimetypes
+from collections import OrderedDict
 from time import time
 from zlib import adler32
 from threading import RLock
@@ -428,6 +429,102 @@ def get_flashed_messages(with_categories=False, category_filter=[]):
     return flashes
 
 
+class _FileMetadata(object):
+    """Metadata of a file sent by :func:`send_file`: modification time,
+    size, etag and the mimetype guessed from its name.
+    """
+    __slots__ = ('mtime', 'size', 'etag', 'mimetype')
+
+    def __init__(self, mtime, size, etag, mimetype):
+        self.mtime = mtime
+        self.size = size
+        self.etag = etag
+        self.mimetype = mimetype
+
+
+class _FileMetadataCache(object):
+    """A small thread safe LRU cache of :class:`_FileMetadata` by
+    filename, where entries expire after a number of seconds.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, filename):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is None or entry[0] < time():
+                return None
+            # reinsert to mark it as most recently used
+            self._entries[filename] = entry
+            return entry[1]
+
+    def set(self, filename, metadata, ttl):
+        with self._lock:
+            self._entries.pop(filename, None)
+            self._entries[filename] = (time() + ttl, metadata)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _get_file_metadata_cache(app):
+    """Return the file metadata cache of the application or `None` if
+    ``SEND_FILE_METADATA_CACHE_SIZE`` disables it.
+    """
+    max_size = app.config['SEND_FILE_METADATA_CACHE_SIZE']
+    if not max_size:
+        return None
+    cache = getattr(app, '_send_file_metadata_cache', None)
+    if cache is None or cache.max_size != max_size:
+        cache = app._send_file_metadata_cache = _FileMetadataCache(max_size)
+    return cache
+
+
+def _get_file_metadata(filename, file=None):
+    """Return the :class:`_FileMetadata` of a file sent by
+    :func:`send_file`, with a single ``stat`` call.  If the file is
+    already open it is used for the call.
+
+    If the metadata cache is enabled, a cached entry is returned without
+    any system call if the file is not open (the ``X-Sendfile`` case),
+    and otherwise it is reused if the modification time and size still
+    match, which saves the etag and mimetype computation.
+    """
+    cache = _get_file_metadata_cache(current_app)
+    cached = cache.get(filename) if cache is not None else None
+    if cached is not None and file is None:
+        return cached
+
+    if file is not None:
+        st = os.fstat(file.fileno())
+    else:
+        st = os.stat(filename)
+    if cached is not None and cached.mtime == st.st_mtime \
+       and cached.size == st.st_size:
+        return cached
+
+    metadata = _FileMetadata(
+        st.st_mtime,
+        st.st_size,
+        '%s-%s-%s' % (
+            st.st_mtime,
+            st.st_size,
+            adler32(
+                filename.encode('utf-8') if isinstance(filename, text_type)
+                else filename
+            ) & 0xffffffff
+        ),
+        mimetypes.guess_type(os.path.basename(filename))[0]
+        or 'application/octet-stream'
+    )
+    if cache is not None:
+        cache.set(filename, metadata,
+                  current_app.config['SEND_FILE_METADATA_CACHE_TTL'])
+    return metadata
+
+
 def send_file(filename_or_fp, mimetype=None, as_attachment=False,
               attachment_filename=None, add_etags=True,
               cache_timeout=None, conditional=False, last_modified=None):
@@ -478,6 +575,10 @@ def send_file(filename_or_fp, mimetype=None, as_attachment=False,
        The `attachment_filename` is preferred over `filename` for MIME-type
        detection.
 
+    .. versionchanged:: 0.13
+       A file given by filename is only ``stat``-ed once.  Its metadata can
+       be cached with ``SEND_FILE_METADATA_CACHE_SIZE``.
+
     :param filename_or_fp: the filename of the file to send in `latin-1`.
                            This is relative to the :attr:`~Flask.root_path`
                            if a relative path is specified.
@@ -506,6 +607,7 @@ def send_file(filename_or_fp, mimetype=None, as_attachment=False,
     """
     mtime = None
     fsize = None
+    metadata = None
     if isinstance(filename_or_fp, string_types):
         filename = filename_or_fp
         if not os.path.isabs(filename):
@@ -513,12 +615,18 @@ def send_file(filename_or_fp, mimetype=None, as_attachment=False,
         file = None
         if attachment_filename is None:
             attachment_filename = os.path.basename(filename)
+        if not current_app.use_x_sendfile:
+            file = open(filename, 'rb')
+        metadata = _get_file_metadata(filename, file)
     else:
         file = filename_or_fp
         filename = None
 
     if mimetype is None:
-        if attachment_filename is not None:
+        if metadata is not None and \
+           attachment_filename == os.path.basename(filename):
+            mimetype = metadata.mimetype
+        elif attachment_filename is not None:
             mimetype = mimetypes.guess_type(attachment_filename)[0] \
                 or 'application/octet-stream'
 
@@ -538,17 +646,14 @@ def send_file(filename_or_fp, mimetype=None, as_attachment=False,
                     filename=attachment_filename)
 
     if current_app.use_x_sendfile and filename:
-        if file is not None:
-            file.close()
         headers['X-Sendfile'] = filename
-        fsize = os.path.getsize(filename)
+        fsize = metadata.size
         headers['Content-Length'] = fsize
         data = None
     else:
-        if file is None:
-            file = open(filename, 'rb')
-            mtime = os.path.getmtime(filename)
-            fsize = os.path.getsize(filename)
+        if metadata is not None:
+            mtime = metadata.mtime
+            fsize = metadata.size
             headers['Content-Length'] = fsize
         data = wrap_file(request.environ, file)
 
@@ -568,20 +673,7 @@ def send_file(filename_or_fp, mimetype=None, as_attachment=False,
         rv.expires = int(time() + cache_timeout)
 
     if add_etags and filename is not None:
-        from warnings import warn
-
-        try:
-            rv.set_etag('%s-%s-%s' % (
-                os.path.getmtime(filename),
-                os.path.getsize(filename),
-                adler32(
-                    filename.encode('utf-8') if isinstance(filename, text_type)
-                    else filename
-                ) & 0xffffffff
-            ))
-        except OSError:
-            warn('Access %s failed, maybe it does not exist, so ignore etags in '
-                 'headers' % filename, stacklevel=2)
+        rv.set_etag(metadata.etag)
 
     if conditional:
         if callable(getattr(Range, 'to_content_range_header', None)):
@@ -309,16 +309,46 @@ class SecureCookieSessionInterface(SessionInterface):
     serializer = session_json_serializer
     session_class = SecureCookieSession
 
+    #: the signing serializers created so far, by the settings they were
+    #: created for.  The default interface is shared by all applications,
+    #: so there is one for each application with a different secret key.
+    _signing_serializers = None
+
+    #: the number of signing serializers that are kept.
+    _max_signing_serializers = 16
+
     def get_signing_serializer(self, app):
+        """Returns the serializer that signs the session cookie, or
+        ``None`` if the application has no secret key.
+
+        A serializer is created once for each secret key and set of
+        signing settings, and reused.
+
+        .. versionchanged:: 0.13
+           The serializer is cached instead of created for every call.
+        """
         if not app.secret_key:
             return None
+        settings = (app.secret_key, self.salt, self.key_derivation,
+                    self.digest_method, self.serializer)
+        serializers = self._signing_serializers
+        if serializers is None:
+            serializers = self._signing_serializers = {}
+        s = serializers.get(settings)
+        if s is not None:
+            return s
         signer_kwargs = dict(
             key_derivation=self.key_derivation,
             digest_method=self.digest_method
         )
-        return URLSafeTimedSerializer(app.secret_key, salt=self.salt,
-                                      serializer=self.serializer,
-                                      signer_kwargs=signer_kwargs)
+        s = URLSafeTimedSerializer(app.secret_key, salt=self.salt,
+                                   serializer=self.serializer,
+                                   signer_kwargs=signer_kwargs)
+        if len(serializers) >= self._max_signing_serializers:
+            # the secret keys changed many times, forget the old ones
+            serializers.clear()
+        serializers[settings] = s
+        return s
 
     def open_session(self, app, request):
         s = self.get_signing_serializer(app)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_sessions
+    ~~~~~~~~~~~~~~
+
+    Benchmarks the session cookie signing of
+    :class:`~flask.sessions.SecureCookieSessionInterface`: getting the
+    signing serializer, and a full ``open_session`` / ``save_session``
+    cycle, with the serializer cache and with a new serializer for every
+    call (the behavior before 0.13).  Two applications with different
+    secret keys share the default interface, like in a process that
+    serves several applications.
+
+    Usage::
+
+        $ python scripts/bench_sessions.py [number]
+
+    :copyright: (c) 2015 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import timeit
+
+from werkzeug.test import EnvironBuilder
+
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+
+class UncachedSessionInterface(SecureCookieSessionInterface):
+    """Creates a new signing serializer for every call."""
+
+    def get_signing_serializer(self, app):
+        self._signing_serializers = None
+        return SecureCookieSessionInterface.get_signing_serializer(self, app)
+
+
+def make_app(secret_key, interface):
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    app.session_interface = interface
+    return app
+
+
+def session_cycle(app, environ):
+    """Open the session of a request, change it and save it."""
+    interface = app.session_interface
+    s = interface.open_session(app, app.request_class(environ))
+    s['count'] = s.get('count', 0) + 1
+    interface.save_session(app, s, app.response_class())
+
+
+def bench(name, func, number, calls):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print('%-45s %8.1f us per call' % (name, seconds / number / calls * 1e6))
+
+
+def main(number):
+    for label, interface in [('cached', SecureCookieSessionInterface()),
+                             ('uncached', UncachedSessionInterface())]:
+        apps = [make_app('first key', interface),
+                make_app('second key', interface)]
+        environs = []
+        for app in apps:
+            cookie = interface.get_signing_serializer(app).dumps({'count': 1})
+            environs.append(EnvironBuilder(
+                headers={'Cookie': 'session=' + cookie}).get_environ())
+
+        bench('get_signing_serializer, %s' % label,
+              lambda: [interface.get_signing_serializer(app) for app in apps],
+              number, len(apps))
+        bench('open_session + save_session, %s' % label,
+              lambda: [session_cycle(app, environ)
+                       for app, environ in zip(apps, environs)],
+              number, len(apps))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -19,6 +19,8 @@ import pickle
 from datetime import datetime
 from threading import Thread
 from flask._compat import text_type
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import BadSignature
 from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 from werkzeug.http import parse_date
 from werkzeug.routing import BuildError
@@ -445,6 +447,89 @@ def test_session_cookie_setting():
     run_test(expect_header=False)
 
 
+def test_session_signing_serializer_cached():
+    app = flask.Flask(__name__)
+    app.secret_key = 'first key'
+    interface = SecureCookieSessionInterface()
+
+    s = interface.get_signing_serializer(app)
+    assert interface.get_signing_serializer(app) is s
+
+    app.secret_key = 'second key'
+    s2 = interface.get_signing_serializer(app)
+    assert s2 is not s
+    assert interface.get_signing_serializer(app) is s2
+    assert s2.loads(s2.dumps({'foo': 42})) == {'foo': 42}
+    with pytest.raises(BadSignature):
+        s2.loads(s.dumps({'foo': 42}))
+
+    interface.salt = 'other salt'
+    assert interface.get_signing_serializer(app) is not s2
+
+    app.secret_key = None
+    assert interface.get_signing_serializer(app) is None
+
+
+def test_session_signing_serializer_per_app():
+    interface = SecureCookieSessionInterface()
+    apps = [flask.Flask(__name__), flask.Flask(__name__)]
+    apps[0].secret_key = 'first key'
+    apps[1].secret_key = 'second key'
+
+    serializers = [interface.get_signing_serializer(app) for app in apps]
+    assert serializers[0] is not serializers[1]
+    for i in range(3):
+        for app, s in zip(apps, serializers):
+            assert interface.get_signing_serializer(app) is s
+
+
+def test_session_signing_serializer_created_once(monkeypatch):
+    created = []
+    original_init = flask.sessions.URLSafeTimedSerializer.__init__
+
+    def counting_init(self, *args, **kwargs):
+        created.append(args[0])
+        original_init(self, *args, **kwargs)
+    monkeypatch.setattr(flask.sessions.URLSafeTimedSerializer, '__init__',
+                        counting_init)
+    apps = [flask.Flask(__name__), flask.Flask(__name__)]
+    # both apps use the default session interface
+    for i, app in enumerate(apps):
+        app.secret_key = 'created once key %d' % i
+
+        @app.route('/')
+        def index():
+            flask.session['count'] = flask.session.get('count', 0) + 1
+            return str(flask.session['count'])
+
+    clients = [app.test_client() for app in apps]
+    for i in range(5):
+        for c in clients:
+            assert c.get('/').data == str(i + 1).encode('ascii')
+    assert created == ['created once key 0', 'created once key 1']
+
+
+def test_session_secret_key_change():
+    app = flask.Flask(__name__)
+    app.secret_key = 'first key'
+    app.testing = True
+
+    @app.route('/set')
+    def set_session():
+        flask.session['foo'] = 42
+        return ''
+
+    @app.route('/get')
+    def get_session():
+        return repr(flask.session.get('foo'))
+
+    c = app.test_client()
+    c.get('/set')
+    assert c.get('/get').data == b'42'
+    app.secret_key = 'second key'
+    assert c.get('/get').data == b'None'
+
+
 def test_flashes():
     app = flask.Flask(__name__)
     app.secret_key = 'testkey'
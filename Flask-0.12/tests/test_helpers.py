@@ -382,6 +382,90 @@ class TestSendfile(object):
             assert rv.mimetype == 'text/html'
             rv.close()
 
+    def test_send_file_stats_once(self, monkeypatch):
+        app = flask.Flask(__name__)
+        stat_calls = []
+
+        def counting(func):
+            def wrapper(*args):
+                stat_calls.append(args)
+                return func(*args)
+            return wrapper
+        monkeypatch.setattr(os, 'stat', counting(os.stat))
+        monkeypatch.setattr(os, 'fstat', counting(os.fstat))
+
+        with app.test_request_context():
+            rv = flask.send_file('static/index.html')
+            assert len(stat_calls) == 1
+            assert rv.headers['Content-Length'] == str(
+                os.path.getsize(os.path.join(app.root_path,
+                                             'static/index.html')))
+            rv.close()
+
+        del stat_calls[:]
+        app.use_x_sendfile = True
+        with app.test_request_context():
+            rv = flask.send_file('static/index.html')
+            assert len(stat_calls) == 1
+            rv.close()
+
+    def test_send_file_metadata_cache(self, monkeypatch):
+        app = flask.Flask(__name__)
+        app.config['SEND_FILE_METADATA_CACHE_SIZE'] = 10
+        with app.test_request_context():
+            rv = flask.send_file('static/index.html')
+            etag = rv.headers['ETag']
+            rv.close()
+
+        guesses = []
+        stat_calls = []
+        guess_type = flask.helpers.mimetypes.guess_type
+        stat = os.stat
+
+        def counting_guess_type(name):
+            guesses.append(name)
+            return guess_type(name)
+
+        def counting_stat(*args):
+            stat_calls.append(args)
+            return stat(*args)
+        monkeypatch.setattr(flask.helpers.mimetypes, 'guess_type',
+                            counting_guess_type)
+        monkeypatch.setattr(os, 'stat', counting_stat)
+
+        # the open file is still checked, but nothing is recomputed
+        with app.test_request_context():
+            rv = flask.send_file('static/index.html')
+            assert rv.headers['ETag'] == etag
+            assert rv.mimetype == 'text/html'
+            assert not guesses
+            rv.close()
+
+        # with x-sendfile, the cached metadata is used as is
+        app.use_x_sendfile = True
+        with app.test_request_context():
+            rv = flask.send_file('static/index.html')
+            assert rv.headers['ETag'] == etag
+            assert rv.mimetype == 'text/html'
+            assert not guesses
+            assert not stat_calls
+            rv.close()
+
+    def test_file_metadata_cache_expiry_and_eviction(self, monkeypatch):
+        cache = flask.helpers._FileMetadataCache(2)
+        cache.set('a', 'A', 10)
+        cache.set('b', 'B', 10)
+        assert cache.get('a') == 'A'
+        cache.set('c', 'C', 10)
+        # b is the least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == 'A'
+        assert cache.get('c') == 'C'
+
+        now = flask.helpers.time()
+        monkeypatch.setattr(flask.helpers, 'time', lambda: now + 11)
+        assert cache.get('a') is None
+
     def test_send_file_last_modified(self):
         app = flask.Flask(__name__)
         last_modified = datetime.datetime(1999, 1, 1)
@@ -6,7 +6,7 @@ from flask import render_template
 # from flask.ext.sqlalchemy import SQLAlchemy
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from catalog.models import Base
 
@@ -17,8 +17,15 @@ app = Flask(__name__)
 app_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 # Load client ids from config files
-client_secret = os.path.join(app_root, 'client_secret_google.json')
+client_secret = os.environ.get('CATALOG_CLIENT_SECRETS',
+    os.path.join(app_root, 'client_secret_google.json'))
 app.config['GOOGLE_CLIENT_ID'] = json.loads(open(client_secret, 'r').read())['web']['client_id']
+# Google endpoints and HTTP settings (see catalog/google_signin.py)
+app.config['GOOGLE_TOKENINFO_URI'] = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+app.config['GOOGLE_USERINFO_URI'] = 'https://www.googleapis.com/oauth2/v1/userinfo'
+app.config['GOOGLE_REVOKE_URI'] = 'https://accounts.google.com/o/oauth2/revoke'
+app.config['GOOGLE_HTTP_TIMEOUT'] = 10               # seconds
+app.config['GOOGLE_HTTP_POOL_SIZE'] = 10             # connections kept open per host
 
 
 # Configuration
@@ -28,15 +35,85 @@ app.config['SECRET_KEY'] = 'super_secret_key'
 app.config['CSRF_SECRET_KEY'] = 'csfr_super_secret_key'
 app.config['UPLOAD_FOLDER'] = os.path.join(app_root, 'uploads')
 app.config['ALLOWED_IMAGE_EXTENSIONS'] = set(['jpg', 'jpeg', 'png', 'gif'])
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # maximum request and image size
+# Resumable image uploads (see catalog/images.py)
+app.config['IMAGE_UPLOAD_CHUNK_SIZE'] = 1024 * 1024  # bytes per request sent by the browser
+app.config['IMAGE_UPLOAD_EXPIRY'] = 24 * 3600        # seconds before unclaimed uploads are removed
+# How uploaded images are sent: 'python', 'x-sendfile' or 'x-accel-redirect'
+# (see catalog/images.py:send_image)
+app.config['IMAGE_SERVING'] = 'python'
+app.config['X_ACCEL_REDIRECT_PREFIX'] = '/protected-uploads/'
+# Cache metadata of files sent by send_file (images and static files)
+app.config['SEND_FILE_METADATA_CACHE_SIZE'] = 1024
+# Uploaded images are resized to fit these sizes (width, height)
+app.config['IMAGE_SIZES'] = {
+    'thumb': (100, 100),
+    'medium': (300, 300),
+    'full': (1200, 1200),
+}
+app.config['ITEMS_PER_PAGE'] = 50  # items per page in category and user pages
+app.config['ATOM_FEED_SIZE'] = 5   # items in the atom feed
+app.config['CHANGES_FEED_DELAY'] = 60  # seconds changes wait before they are in changes.json
+
+# Background jobs (see catalog/jobs.py)
+app.config['JOB_WORKERS'] = 2          # worker threads per process, 0 to disable
+app.config['JOB_POLL_INTERVAL'] = 5    # seconds between checks for new jobs
+app.config['JOB_TIMEOUT'] = 600        # seconds before a running job is retried
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETENTION_DAYS'] = 7     # days finished and failed jobs are kept
+app.config['JOB_PURGE_INTERVAL'] = 86400  # seconds between purges of old jobs
+
+# Cache configuration (see catalog/cache.py)
+app.config['CACHE_TYPE'] = 'simple'
+app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+app.config['CACHE_REDIS_HOST'] = 'localhost'
+app.config['CACHE_REDIS_PORT'] = 6379
+app.config['USER_CACHE_TIMEOUT'] = 60  # seconds users are cached in each process (see catalog/users.py)
+
+# Where session data is kept: 'cookie', 'memory' or 'database' (see catalog/sessions.py)
+app.config['SESSION_STORE'] = 'cookie'
+app.config['SESSION_CLEANUP_INTERVAL'] = 3600  # seconds between removals of expired sessions
+
+# Query instrumentation (see catalog/query_stats.py)
+app.config['SLOW_QUERY_THRESHOLD'] = 0.5    # seconds, slower queries are logged
+app.config['SERVER_TIMING'] = True          # send query count and time in a Server-Timing header
+app.config['QUERY_STATS_FOOTER'] = False    # list the queries of each page in a footer
+
+# Database configuration
+app.config['DATABASE_URI'] = os.environ.get('CATALOG_DATABASE_URI', 'postgresql:///catalog')
+app.config['DATABASE_POOL_SIZE'] = 10        # connections kept open per process
+app.config['DATABASE_MAX_OVERFLOW'] = 20     # extra connections allowed under load
+app.config['DATABASE_POOL_PRE_PING'] = True  # test connections before using them
+app.config['DATABASE_POOL_RECYCLE'] = 1800   # seconds before a connection is replaced
 
 
 # Connect to database and create database session
-engine = create_engine('postgresql:///catalog')
+def create_db_engine(config):
+    """Create the database engine with the connection pool settings in config.
+
+    Pool sizing does not apply to sqlite, which uses its own pool class.
+    """
+    options = dict(
+        pool_pre_ping = config['DATABASE_POOL_PRE_PING'],
+        pool_recycle = config['DATABASE_POOL_RECYCLE'])
+    if not config['DATABASE_URI'].startswith('sqlite'):
+        options.update(
+            pool_size = config['DATABASE_POOL_SIZE'],
+            max_overflow = config['DATABASE_MAX_OVERFLOW'])
+    return create_engine(config['DATABASE_URI'], **options)
+
+engine = create_db_engine(app.config)
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind = engine)
-db = DBSession()
+# Each thread gets its own session, which is removed at the end of the request
+db = scoped_session(DBSession)
 # db = SQLAlchemy(app)
 
+@app.teardown_appcontext
+def shutdown_session(exception = None):
+    """Remove the current session, returning its connection to the pool."""
+    db.remove()
+
 
 # Register HTTP error handlers
 @app.errorhandler(404)
@@ -54,6 +131,8 @@ def unhandled_exception(e):
 
 # Import modules
 import catalog.models
+import catalog.query_stats
+import catalog.sessions
 
 # Register blueprints
 from views.api import api
@@ -63,3 +142,6 @@ from views.data import data
 app.register_blueprint(api)
 app.register_blueprint(auth)
 app.register_blueprint(data)
+
+# Register command line tools
+import catalog.commands
@@ -0,0 +1,65 @@
+"""Application cache.
+
+The cache backend is chosen with the CACHE_TYPE config setting:
+
+    simple: in-process cache (default). Each server process has its own
+        cache, and invalidations only reach the process that makes them:
+        the other processes may serve stale values for up to
+        CACHE_DEFAULT_TIMEOUT seconds.
+    redis: cache shared by all server processes, see CACHE_REDIS_*.
+        Invalidations reach every process immediately.
+    null: no caching.
+
+Cached values are grouped by what they depend on (for example, "items").
+Each group has a version, which is part of the cache keys of its values.
+Invalidating a group changes its version, so all its values are missed.
+Versions expire after CACHE_DEFAULT_TIMEOUT seconds like any other value,
+which is what bounds the staleness of the simple cache.
+"""
+
+import uuid
+
+from werkzeug.contrib.cache import NullCache, RedisCache, SimpleCache
+
+from catalog import app
+
+
+def create_cache(config):
+    """Create the cache backend selected in config."""
+    cache_type = config['CACHE_TYPE']
+    timeout = config['CACHE_DEFAULT_TIMEOUT']
+    if cache_type == 'simple':
+        return SimpleCache(default_timeout = timeout)
+    if cache_type == 'redis':
+        return RedisCache(
+            host = config['CACHE_REDIS_HOST'],
+            port = config['CACHE_REDIS_PORT'],
+            default_timeout = timeout,
+            key_prefix = 'catalog:')
+    if cache_type == 'null':
+        return NullCache()
+    raise ValueError("Unknown cache type: %r" % cache_type)
+
+cache = create_cache(app.config)
+
+
+################################################################################
+# Versioned groups of cached values
+################################################################################
+
+def get_version(group):
+    """Get the current version of a group of cached values."""
+    key = 'version:' + group
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(key, version)
+    return version
+
+def make_key(group, *parts):
+    """Make a cache key for a value in a group."""
+    return ':'.join([group, get_version(group)] + [unicode(p) for p in parts])
+
+def invalidate(group):
+    """Invalidate all cached values in a group."""
+    cache.set('version:' + group, uuid.uuid4().hex)
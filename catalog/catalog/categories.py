@@ -0,0 +1,65 @@
+"""Cached list of categories.
+
+Categories change almost never, but the item forms and the catalog sidebar
+list them on every request. Each server process keeps the sorted list in
+memory, together with the version of the "categories" cache group (see
+catalog/cache.py) it was loaded at. Committing a change to a category
+invalidates the group, so every process reloads the list on its next use.
+With the default simple cache, other processes only see the new version
+when their own copy of it expires, up to CACHE_DEFAULT_TIMEOUT seconds
+later; use the redis cache for immediate updates.
+
+Note: categories changed with bulk queries (Query.update or Query.delete)
+are not detected. Call invalidate('categories') after those.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from catalog import db
+from catalog import DBSession
+from catalog.cache import get_version, invalidate
+from catalog.models import Category
+
+
+# Cached category. It is also a (value, label) tuple for SelectField choices.
+CachedCategory = namedtuple('CachedCategory', ['id', 'name'])
+
+# (version, categories) loaded by this process
+_categories = (None, [])
+
+
+def get_categories():
+    """Get all categories, sorted by name.
+
+    Returns:
+      A list of CachedCategory tuples (id, name).
+    """
+    global _categories
+    version = get_version('categories')
+    loaded_version, categories = _categories
+    if loaded_version != version:
+        categories = [CachedCategory(id, name) for id, name in
+            db.query(Category.id, Category.name).order_by(Category.name)]
+        _categories = (version, categories)
+    return categories
+
+
+@event.listens_for(DBSession, 'before_flush')
+def track_category_changes(session, flush_context, instances):
+    """Remember that categories changed, to invalidate them on commit."""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Category):
+            session.info['categories_changed'] = True
+            return
+
+@event.listens_for(DBSession, 'after_commit')
+def invalidate_categories(session):
+    """Invalidate the cached categories when changes are committed."""
+    if session.info.pop('categories_changed', False):
+        invalidate('categories')
+
+@event.listens_for(DBSession, 'after_rollback')
+def forget_category_changes(session):
+    session.info.pop('categories_changed', None)
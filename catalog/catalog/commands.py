@@ -0,0 +1,307 @@
+"""Command line tools, run with the flask command:
+
+    $ export FLASK_APP=catalog
+    $ flask catalog-load --users users.csv --categories categories.csv --items items.jsonl
+    $ flask catalog-export backups/2016-05-01
+"""
+
+import codecs
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+
+from sqlalchemy import and_, DateTime, literal, select
+
+from catalog import app
+from catalog import db
+from catalog import engine
+from catalog import DBSession
+from catalog.cache import invalidate
+from catalog.images import recount_image_references
+from catalog.models import User, Category, Item, DeletedItem
+from catalog.views.data import parse_datetime
+
+
+################################################################################
+# Bulk load
+################################################################################
+
+# Tables that can be loaded, in the order they are loaded (parents first)
+LOAD_TABLES = [
+    ('users', User.__table__),
+    ('categories', Category.__table__),
+    ('items', Item.__table__),
+]
+
+# Rows per transaction
+LOAD_CHUNK_SIZE = 10000
+
+def open_data_file(path):
+    """Open a data file for reading text. Files ending in .gz are decompressed."""
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path, 'rb')), encoding = 'utf-8')
+    return io.open(path, encoding = 'utf-8')
+
+def read_rows(path):
+    """Read the rows of a CSV (with a header line) or JSONL file, as dicts.
+
+    The format is chosen by the file extension: .csv or .jsonl, optionally
+    followed by .gz. Empty CSV values are read as None.
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    with open_data_file(path) as f:
+        if name.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif name.endswith('.csv'):
+            # the Python 2 csv module does not read unicode
+            for row in csv.DictReader(codecs.iterencode(f, 'utf-8')):
+                yield dict((key, value.decode('utf-8') if value != '' else None)
+                    for key, value in row.items())
+        else:
+            raise click.BadParameter("Unknown file format: %s" % path)
+
+def convert_row(table, row, now):
+    """Convert the values of a row to the types of the table columns.
+
+    Missing values are set to None, except created and updated dates,
+    which are set to now.
+    """
+    values = {}
+    for column in table.columns:
+        value = row.get(column.name)
+        if value is None and column.name in ('created', 'updated'):
+            value = now
+        elif isinstance(value, basestring) and column.type.python_type is int:
+            value = int(value)
+        elif isinstance(value, basestring) and column.type.python_type is datetime:
+            value = parse_datetime(value)
+        values[column.name] = value
+    return values
+
+def copy_csv_value(value):
+    """Format a value for COPY ... CSV: None is an unquoted empty value."""
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return '"%s"' % unicode(value).replace('"', '""').encode('utf-8')
+
+def insert_rows(connection, table, rows):
+    """Insert rows into a table, with COPY on PostgreSQL or executemany on others."""
+    if engine.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+    names = [c.name for c in table.columns]
+    data = io.BytesIO()
+    for row in rows:
+        data.write(','.join(copy_csv_value(row[name]) for name in names) + '\n')
+    data.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV" % (table.name, ', '.join(names)), data)
+
+def reset_id_sequence(connection, table):
+    """Make the id sequence of a table continue after the loaded ids (PostgreSQL)."""
+    if engine.dialect.name == 'postgresql':
+        connection.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "coalesce(max(id), 0) + 1, false) FROM %s" % (table.name, table.name))
+
+def write_tombstones(connection, now):
+    """Add a DeletedItem tombstone for every item, so clients that mirror the
+    catalog (see the changes feed) remove the items that are replaced."""
+    items = Item.__table__
+    connection.execute(DeletedItem.__table__.insert().from_select(
+        ['item_id', 'category_id', 'deleted'],
+        select([items.c.id, items.c.category_id, literal(now, DateTime)])))
+
+def remove_reloaded_tombstones(connection, now):
+    """Remove the tombstones written by write_tombstones for items that were
+    loaded again with the same ID, which are changed rather than deleted."""
+    tombstones = DeletedItem.__table__
+    connection.execute(tombstones.delete().where(and_(
+        tombstones.c.deleted == literal(now, DateTime),
+        tombstones.c.item_id.in_(select([Item.__table__.c.id])))))
+
+def load_table(table, path, chunk_size):
+    """Load the rows of a file into a table, one transaction per chunk.
+
+    Returns:
+      The number of rows loaded.
+    """
+    now = datetime.utcnow()
+    rows = (convert_row(table, row, now) for row in read_rows(path))
+    count = 0
+    start = time.time()
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        with engine.begin() as connection:
+            insert_rows(connection, table, chunk)
+        count += len(chunk)
+        click.echo("%s: %d rows (%d rows/s)" %
+            (table.name, count, count / max(time.time() - start, 0.001)), err = True)
+    with engine.begin() as connection:
+        reset_id_sequence(connection, table)
+    return count
+
+@app.cli.command('catalog-load')
+@click.option('--users', type = click.Path(exists = True), help = "Users file.")
+@click.option('--categories', type = click.Path(exists = True), help = "Categories file.")
+@click.option('--items', type = click.Path(exists = True), help = "Items file.")
+@click.option('--chunk-size', default = LOAD_CHUNK_SIZE, help = "Rows per transaction.")
+@click.option('--replace', is_flag = True, help = "Delete the rows of the loaded tables first.")
+def catalog_load(users, categories, items, chunk_size, replace):
+    """Bulk load users, categories and items from CSV or JSONL files.
+
+    \b
+    The columns (CSV header or JSON keys) are the table columns:
+        users: id, name, email, picture
+        categories: id, name
+        items: id, name, description, image, category_id, user_id, created, updated
+    Files can be gzip compressed (.csv.gz, .jsonl.gz).
+
+    Rows are inserted with COPY on PostgreSQL, and with executemany on other
+    databases, in one transaction per chunk. If a chunk fails, the chunks
+    before it stay loaded.
+
+    With --replace, deleted items get tombstones in the changes feed, like
+    items deleted in the app, unless they are loaded again with the same ID.
+
+    Item images must already be in the upload folder. The reference counts
+    of images are recomputed after loading items, and the files of images
+    no longer used by any item are removed by a job.
+
+    The cached categories and items are invalidated at the end. Server
+    processes only see this immediately with the redis cache; with the
+    simple cache, each process keeps its cached values until they expire
+    (CACHE_DEFAULT_TIMEOUT).
+    """
+    paths = dict(users = users, categories = categories, items = items)
+    tables = [(table, paths[name]) for name, table in LOAD_TABLES if paths[name]]
+    if not tables:
+        raise click.UsageError("Nothing to load: give at least one of --users, --categories, --items.")
+
+    replaced = datetime.utcnow()
+    if replace:
+        with engine.begin() as connection:
+            if items:
+                write_tombstones(connection, replaced)
+            for table, path in reversed(tables):
+                connection.execute(table.delete())
+
+    start = time.time()
+    try:
+        for table, path in tables:
+            count = load_table(table, path, chunk_size)
+            click.echo("Loaded %d %s from %s" % (count, table.name, path))
+    finally:
+        # also after a failed chunk, for the items loaded before it
+        if items:
+            if replace:
+                with engine.begin() as connection:
+                    remove_reloaded_tombstones(connection, replaced)
+            recount_image_references()
+            db.commit()
+    click.echo("Done in %.1f s" % (time.time() - start))
+
+    invalidate('categories')
+    invalidate('items')
+    if app.config['CACHE_TYPE'] == 'simple':
+        click.echo("Server processes may show cached data for up to %d s "
+            "(the simple cache is not shared with them)." % app.config['CACHE_DEFAULT_TIMEOUT'])
+
+
+################################################################################
+# Export
+################################################################################
+
+# Models that are exported, with their file names
+EXPORT_MODELS = [
+    ('users', User),
+    ('categories', Category),
+    ('items', Item),
+]
+
+# Rows fetched from the database at a time
+EXPORT_BATCH_SIZE = 1000
+
+def file_sha256(path):
+    """Get the SHA-256 hash of a file, in hex."""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def export_model(session, model, path):
+    """Write all rows of a model to a gzip compressed JSONL file, in id order.
+
+    Rows are fetched in batches with a server-side cursor (on PostgreSQL),
+    so memory use does not depend on the size of the table.
+
+    Returns:
+      The number of rows written.
+    """
+    count = 0
+    with gzip.open(path + '.tmp', 'wb') as f:
+        for obj in session.query(model).order_by(model.id).yield_per(EXPORT_BATCH_SIZE):
+            f.write(json.dumps(obj.serialize) + '\n')
+            count += 1
+    os.rename(path + '.tmp', path)
+    return count
+
+@app.cli.command('catalog-export')
+@click.argument('folder', type = click.Path(file_okay = False))
+def catalog_export(folder):
+    """Export users, categories and items to gzip compressed JSONL files.
+
+    \b
+    FOLDER gets one file per table, and a manifest.json file with the
+    number of rows and SHA-256 hash of each file. The manifest is written
+    last, so a folder without one has an incomplete export.
+
+    All tables are read in one transaction, so they are consistent with
+    each other. Rows are written with the serialize property of their
+    model, which is the format of catalog.json. The files can be loaded
+    with catalog-load.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    manifest = {
+        'created': datetime.utcnow().isoformat(),
+        'tables': {},
+    }
+    connection = engine.connect()
+    if engine.dialect.name == 'postgresql':
+        # see the same snapshot in all queries
+        connection = connection.execution_options(isolation_level = 'REPEATABLE READ')
+    try:
+        with connection.begin():
+            session = DBSession(bind = connection)
+            for name, model in EXPORT_MODELS:
+                filename = name + '.jsonl.gz'
+                path = os.path.join(folder, filename)
+                count = export_model(session, model, path)
+                manifest['tables'][name] = {
+                    'file': filename,
+                    'rows': count,
+                    'sha256': file_sha256(path),
+                }
+                click.echo("Exported %d %s to %s" % (count, name, path))
+            session.close()
+    finally:
+        connection.close()
+
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
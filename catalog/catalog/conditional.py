@@ -0,0 +1,51 @@
+"""Conditional GET support (ETag, Last-Modified and 304 Not Modified).
+
+Views compute cheap validators for their content, usually from
+Item.updated, and pass a function that renders the full response.
+If the client already has the current version, the view answers
+304 Not Modified without rendering anything.
+
+Views of a collection of items (a category, the Atom feed) only send an
+ETag. Their newest item date is not a valid Last-Modified: deleting an
+item, or moving it to another category, changes the collection without
+raising it, and a client that only sends If-Modified-Since would keep
+its stale copy.
+"""
+
+import hashlib
+
+from flask import make_response
+from flask import request
+from flask import session
+
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """Make an ETag from a list of values that identify a version of the content."""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def conditional_response(etag, last_modified, render):
+    """Return 304 Not Modified if the client has the current version.
+
+    Otherwise, call render to build the full response.
+    Both responses include the ETag and Last-Modified headers.
+
+    Responses are always rendered while there are flashed messages in the
+    session, since the messages are only shown once.
+
+    Args:
+      etag: the ETag of the current version, see make_etag.
+      last_modified: date and time (UTC) of the last change, or None.
+      render: function that returns the full response (or response body).
+    """
+    if '_flashes' not in session and \
+            not is_resource_modified(request.environ,
+                etag = etag, last_modified = last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
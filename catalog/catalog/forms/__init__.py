@@ -43,7 +43,7 @@ class ImageFileValidator(object):
         self.message = message
 
     def __call__(self, form, field):
-        form_file = request.files[field.name]
+        form_file = request.files.get(field.name)
         if form_file and not self.allowed_file(form_file):
             raise ValidationError(self.message)
 
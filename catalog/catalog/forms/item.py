@@ -1,6 +1,6 @@
 from catalog.forms import CSRFForm, ImageFileValidator
 
-from wtforms import Form, TextField, TextAreaField, SelectField, FileField
+from wtforms import Form, TextField, TextAreaField, SelectField, FileField, HiddenField
 from wtforms import validators, ValidationError
 
 class ItemForm(CSRFForm):
@@ -13,3 +13,6 @@ class ItemForm(CSRFForm):
     category_id = SelectField("Category", coerce = int)
 
     image = FileField("Image", [ImageFileValidator()])
+
+    # ID of a finalized resumable upload, used instead of the image field
+    image_upload = HiddenField()
@@ -0,0 +1,155 @@
+"""Google sign-in helpers.
+
+All requests to Google go through one requests session, which keeps
+connections open between requests, so that signing in does not cost a new
+TLS handshake for each call. The client secrets are read once, when the
+module is loaded.
+
+Access tokens are revoked by a background job (see catalog/jobs.py), so
+that signing out does not wait for Google. Failed revocations are retried
+with the job's retries. The token is removed from the job when it is done
+or failed.
+
+The Google endpoints are set in the config (GOOGLE_*_URI), so they can be
+pointed to a local server for testing. The token endpoint is the token_uri
+of the client secrets file.
+"""
+
+import logging
+import threading
+from collections import Counter
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+from oauth2client import clientsecrets
+from oauth2client.client import OAuth2WebServerFlow
+
+from catalog import app
+from catalog import client_secret
+from catalog.jobs import enqueue, job_handler
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################################################
+# HTTP session
+################################################################################
+
+def create_http_session(config):
+    """Create a requests session with a connection pool for Google's servers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections = 4,
+        pool_maxsize = config['GOOGLE_HTTP_POOL_SIZE'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = create_http_session(app.config)
+
+class SessionHttp(object):
+    """httplib2.Http-like wrapper of the requests session, for oauth2client."""
+
+    def request(self, uri, method = 'GET', body = None, headers = None, **kwargs):
+        response = http_session.request(method, uri, data = body, headers = headers,
+            timeout = app.config['GOOGLE_HTTP_TIMEOUT'])
+        info = dict(response.headers)
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+
+################################################################################
+# Sign-in
+################################################################################
+
+def create_oauth_flow(client_secrets_file):
+    """Create the OAuth flow for the client in a client secrets file."""
+    client_type, client_info = clientsecrets.loadfile(client_secrets_file)
+    return OAuth2WebServerFlow(
+        client_id = client_info['client_id'],
+        client_secret = client_info['client_secret'],
+        scope = '',
+        redirect_uri = 'postmessage',
+        auth_uri = client_info['auth_uri'],
+        token_uri = client_info['token_uri'])
+
+oauth_flow = create_oauth_flow(client_secret)
+
+def exchange_code(code):
+    """Upgrade an authorization code into a credentials object.
+
+    Raises:
+      FlowExchangeError: if the code is not valid.
+    """
+    return oauth_flow.step2_exchange(code, http = SessionHttp())
+
+def get_token_info(access_token):
+    """Get the info of an access token (user, audience, expiry...).
+
+    Returns:
+      A dict with the token info, which has an "error" key if the token is
+      not valid.
+    """
+    response = http_session.get(app.config['GOOGLE_TOKENINFO_URI'],
+        params = {'access_token': access_token},
+        timeout = app.config['GOOGLE_HTTP_TIMEOUT'])
+    return response.json()
+
+def get_user_profile(access_token):
+    """Get the name, email and picture of the user of an access token."""
+    response = http_session.get(app.config['GOOGLE_USERINFO_URI'],
+        params = {'access_token': access_token, 'alt': 'json'},
+        timeout = app.config['GOOGLE_HTTP_TIMEOUT'])
+    return response.json()
+
+
+
+################################################################################
+# Sign-out
+################################################################################
+
+# Outcomes of token revocations in this process: "revoked", "invalid"
+# (expired or already revoked) and "error" (failed attempts)
+revocation_counts = Counter()
+revocation_counts_lock = threading.Lock()
+
+def count_revocation(outcome):
+    """Count the outcome of a revocation, and return the count."""
+    with revocation_counts_lock:
+        revocation_counts[outcome] += 1
+        return revocation_counts[outcome]
+
+def revoke_token_later(access_token):
+    """Queue a job to revoke an access token, in the current database session."""
+    enqueue('revoke_token', access_token = access_token)
+
+@job_handler('revoke_token', secret_payload = True)
+def revoke_token(access_token):
+    """Revoke an access token.
+
+    Raises:
+      requests.RequestException: if Google could not be reached, or had an
+        error. The job is then retried.
+    """
+    try:
+        response = http_session.get(app.config['GOOGLE_REVOKE_URI'],
+            params = {'token': access_token},
+            timeout = app.config['GOOGLE_HTTP_TIMEOUT'])
+        if response.status_code >= 500:
+            response.raise_for_status()
+    except requests.RequestException as e:
+        count = count_revocation('error')
+        logger.warning("Token revocation failed (%d failures): %s", count, e)
+        raise
+
+    if response.status_code == 200:
+        count = count_revocation('revoked')
+        logger.info("Token revoked (%d revoked)", count)
+    else:
+        # the token expired, or was revoked already: nothing left to do
+        count = count_revocation('invalid')
+        logger.info("Token not revoked, status %d (%d not revoked)",
+            response.status_code, count)
@@ -0,0 +1,546 @@
+"""Processing and storage of uploaded item images.
+
+Uploaded images are not stored as they are. Instead, they are resized and
+re-encoded into a fixed set of variants (see the IMAGE_SIZES config setting),
+so pages can request an image no bigger than they need.
+
+Images are named after the SHA-256 hash of the uploaded file, so the same
+upload always gets the same name (and URL), and is stored only once. The
+image_files table counts the items using each image, and the files are
+removed when no item uses them anymore.
+
+Files are stored in subfolders of UPLOAD_FOLDER named after the first
+characters of the hash, to keep folders small. The variants of an image
+are stored next to each other: for an image named "<hash>.jpg", the
+variants are "<hash>_thumb.jpg", "<hash>_medium.jpg" and so on.
+
+Uploads are saved as they are under the image name, and the variants are
+made by a background job, which then removes the upload. Until then, the
+upload is served for all sizes (see api.view_image).
+
+A new image is moved into the store only after the transaction that adds
+its image_files row commits, so a rolled back request never leaves files
+behind, and a delete_image job never sees files without a row. Moving
+files into the store and removing them is done under one lock file.
+
+Images uploaded before content addressing have random names, and are
+stored directly in UPLOAD_FOLDER, without a reference count.
+
+Large images can also be uploaded in chunks, with resumable uploads:
+
+    1. create_upload starts an upload, with an empty partial file.
+    2. append_upload appends each chunk to the partial file, at the offset
+       given by the client. After a failure, the client asks for the
+       current offset (the size of the partial file) and resumes from there.
+    3. finalize_upload stores the partial file as an image, like save_image.
+    4. claim_upload hands the image over to an item.
+
+Uploads that are not claimed within IMAGE_UPLOAD_EXPIRY seconds are removed.
+"""
+
+import errno
+import fcntl
+import hashlib
+import mimetypes
+import os
+import re
+import time
+import uuid
+
+from PIL import Image
+
+from contextlib import contextmanager
+
+from flask import abort
+from flask import Response
+from flask import send_file
+from flask.helpers import safe_join
+
+from sqlalchemy import and_, event, func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+from catalog import app
+from catalog import db
+from catalog import DBSession
+from catalog.jobs import enqueue, job_handler
+from catalog.models import Item, ImageFile, ImageUpload, Job
+
+
+# Quality of re-encoded JPEG images (1 to 95)
+JPEG_QUALITY = 85
+
+# Files younger than this (in seconds) are never removed as orphans,
+# since they may belong to an item that is being created.
+ORPHAN_GRACE_PERIOD = 3600
+
+# Size of the chunks in which uploads are copied and hashed
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Lock file in UPLOAD_FOLDER, held while image files are moved or removed
+IMAGES_LOCK_FILE = 'images.lock'
+
+# Names of content addressed images and their variants
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}(_[a-z]+)?\.(jpg|png)$')
+
+
+def variant_filename(filename, size):
+    """Get the file name of a size variant of an image."""
+    stem, ext = os.path.splitext(filename)
+    return "%s_%s%s" % (stem, size, ext)
+
+def image_filenames(filename):
+    """Get the names of all files that may be stored for an image."""
+    return [filename] + [variant_filename(filename, size)
+        for size in app.config['IMAGE_SIZES']]
+
+def is_content_addressed(filename):
+    """Check if an image (or variant) file name is a content hash."""
+    return CONTENT_ADDRESSED_NAME.match(filename) is not None
+
+def image_path(filename):
+    """Get the path of an image (or variant) file.
+
+    Raises:
+      NotFound: if the file name is not safe (for example, "..").
+    """
+    if is_content_addressed(filename):
+        return os.path.join(app.config['UPLOAD_FOLDER'],
+            filename[0:2], filename[2:4], filename)
+    return safe_join(app.config['UPLOAD_FOLDER'], filename)
+
+def has_transparency(image):
+    """Check if an image has transparent pixels (or may have)."""
+    return image.mode in ('RGBA', 'LA') or \
+        (image.mode == 'P' and 'transparency' in image.info)
+
+def image_extension(file):
+    """Get the extension an image is saved with: .png if it has transparency,
+    .jpg otherwise.
+
+    Only the image header is decoded. The file is rewound afterwards.
+
+    Raises:
+      IOError: if the file is not a valid image.
+    """
+    image = Image.open(file)
+    ext = '.png' if has_transparency(image) else '.jpg'
+    file.seek(0)
+    return ext
+
+def save_image(file):
+    """Save an uploaded image, and add a reference to it.
+
+    If the same file was uploaded before, the stored image is reused.
+    Otherwise, the upload is stored and a job is queued to make its size
+    variants. Images with transparency are saved as PNG, all others as JPEG.
+    Only the image header is decoded here, to check that the file is an
+    image and to choose the format.
+
+    Args:
+      file: the uploaded file.
+    Returns:
+      The image name, which is the hash of the file and the extension of
+      the format it is saved in. Use variant_filename to get the names of
+      the size variants.
+    Raises:
+      IOError: if the file is not a valid image.
+    """
+    ext = image_extension(file)
+
+    # copy the upload to a temporary file, and hash it on the way
+    folder = app.config['UPLOAD_FOLDER']
+    temp_path = os.path.join(folder, 'upload_%s.tmp' % uuid.uuid4().hex)
+    file_hash = hashlib.sha256()
+    with open(temp_path, 'wb') as temp_file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+            temp_file.write(chunk)
+    return store_image(temp_path, file_hash.hexdigest() + ext)
+
+def add_image_reference(filename):
+    """Add a reference to an image, creating its image_files row if needed.
+
+    On PostgreSQL this is a single INSERT ... ON CONFLICT ... RETURNING
+    query. On SQLite the row is inserted if no row was updated: the UPDATE
+    takes the database write lock, so no other transaction can insert the
+    row in between.
+
+    Returns:
+      True if the row was created.
+    """
+    table = ImageFile.__table__
+    if db.get_bind().dialect.name == 'postgresql':
+        insert = postgresql_insert(table).values(name = filename, ref_count = 1)
+        insert = insert.on_conflict_do_update(
+            index_elements = [table.c.name],
+            set_ = dict(ref_count = table.c.ref_count + 1)) \
+            .returning(table.c.ref_count)
+        # rows are deleted when their count drops to 0, so 1 is a new row
+        return db.execute(insert).scalar() == 1
+
+    update = table.update().where(table.c.name == filename) \
+        .values(ref_count = table.c.ref_count + 1)
+    if db.execute(update).rowcount:
+        return False
+    db.execute(table.insert().values(name = filename, ref_count = 1))
+    return True
+
+def store_image(temp_path, filename):
+    """Store an image file under its name, and add a reference to it.
+
+    A new image is moved into the store when the transaction commits, and
+    a job is queued to make its size variants.
+
+    Args:
+      temp_path: path of the file, in UPLOAD_FOLDER. It is moved into the
+        image store, or removed if the image is stored already.
+      filename: image name.
+    Returns:
+      The image name.
+    """
+    if not add_image_reference(filename):
+        # same image uploaded before
+        os.remove(temp_path)
+        return filename
+
+    db.info.setdefault('stored_images', []).append((temp_path, filename))
+    enqueue('process_image', filename = filename)
+    return filename
+
+@contextmanager
+def locked_images():
+    """Hold the lock for moving image files into the store and removing them."""
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], IMAGES_LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+@event.listens_for(DBSession, 'after_commit')
+def move_stored_images(session):
+    """Move the images stored in a transaction into the store, once it commits."""
+    stored_images = session.info.pop('stored_images', [])
+    if not stored_images:
+        return
+    with locked_images():
+        for temp_path, filename in stored_images:
+            path = image_path(filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(temp_path, path)
+
+@event.listens_for(DBSession, 'after_rollback')
+def remove_stored_images(session):
+    """Remove the files of images stored in a transaction that rolled back."""
+    for temp_path, filename in session.info.pop('stored_images', []):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class UploadBusyError(Exception):
+    """Another request is writing to or finalizing the upload."""
+    pass
+
+class UploadOffsetError(ValueError):
+    """The offset of an upload chunk is not the current size of the upload."""
+
+    def __init__(self, offset):
+        ValueError.__init__(self, "Expected offset %d" % offset)
+        self.offset = offset
+
+def upload_path(upload_id):
+    """Get the path of the partial file of a resumable upload."""
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'upload_%s.part' % upload_id)
+
+@contextmanager
+def locked_upload(upload):
+    """Open the partial file of an upload, with an exclusive lock.
+
+    Yields:
+      The file, open for reading and writing, positioned at the end.
+    Raises:
+      UploadBusyError: if another request holds the lock, or the file was
+        moved to the image store by another request.
+    """
+    try:
+        part = open(upload_path(upload.id), 'r+b')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise UploadBusyError("Upload %s is finalized" % upload.id)
+    with part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise UploadBusyError("Upload %s is in use" % upload.id)
+        part.seek(0, os.SEEK_END)
+        yield part
+
+def upload_offset(upload):
+    """Get the number of bytes received for an upload so far."""
+    try:
+        return os.path.getsize(upload_path(upload.id))
+    except OSError:
+        return 0
+
+def create_upload(user_id):
+    """Start a resumable upload, with an empty partial file.
+
+    A job is queued to remove the upload if it is not claimed in time.
+
+    Returns:
+      The new upload.
+    """
+    upload = ImageUpload(id = uuid.uuid4().hex, user_id = user_id)
+    open(upload_path(upload.id), 'wb').close()
+    db.add(upload)
+    enqueue('expire_image_upload', delay = app.config['IMAGE_UPLOAD_EXPIRY'],
+        upload_id = upload.id)
+    return upload
+
+def append_upload(upload, offset, stream, length):
+    """Append a chunk to a resumable upload.
+
+    The chunk is copied from the stream to the partial file as it arrives,
+    without buffering it. If the stream ends early, the data received so
+    far is kept, and the client can resume from the new offset.
+
+    Args:
+      upload: the upload.
+      offset: offset of the chunk, which must be the current upload size.
+      stream: request body stream.
+      length: chunk size.
+    Returns:
+      The new upload size.
+    Raises:
+      UploadOffsetError: if the offset is not the current upload size.
+      UploadBusyError: if another request is writing to the upload.
+    """
+    if upload.image is not None:
+        raise UploadBusyError("Upload %s is finalized" % upload.id)
+    with locked_upload(upload) as part:
+        size = part.tell()
+        if offset != size:
+            raise UploadOffsetError(size)
+        while length > 0:
+            chunk = stream.read(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            part.write(chunk)
+            length -= len(chunk)
+        return part.tell()
+
+def finalize_upload(upload):
+    """Store the data of a resumable upload as an image.
+
+    The image is referenced by the upload until it is claimed by an item.
+
+    Returns:
+      The image name.
+    Raises:
+      IOError: if the data is not a valid image.
+      UploadBusyError: if another request is writing to the upload.
+    """
+    if upload.image is not None:
+        return upload.image
+    with locked_upload(upload) as part:
+        part.seek(0)
+        ext = image_extension(part)
+        file_hash = hashlib.sha256()
+        for chunk in iter(lambda: part.read(COPY_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+        # move the partial file away, so no more chunks are appended to it
+        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'upload_%s.tmp' % upload.id)
+        os.rename(upload_path(upload.id), temp_path)
+    upload.image = store_image(temp_path, file_hash.hexdigest() + ext)
+    return upload.image
+
+def claim_upload(upload_id, user_id):
+    """Hand over the image of a finalized upload, and remove the upload.
+
+    The caller takes over the upload's reference to the image.
+
+    Returns:
+      The image name.
+    Raises:
+      ValueError: if there is no finalized upload with this ID for the user.
+    """
+    upload = db.query(ImageUpload) \
+        .filter_by(id = upload_id, user_id = user_id) \
+        .filter(ImageUpload.image != None).first()
+    if upload is None:
+        raise ValueError("Unknown upload: %r" % upload_id)
+    db.delete(upload)
+    return upload.image
+
+def send_image(path):
+    """Send an image file, with the backend selected by IMAGE_SERVING.
+
+        python: the file is sent by the app. The WSGI server's file wrapper
+            is used if it has one (many use sendfile).
+        x-sendfile: the front server (Apache with mod_xsendfile, lighttpd)
+            sends the file named in the X-Sendfile header.
+        x-accel-redirect: nginx sends the file, from an internal location
+            that maps X_ACCEL_REDIRECT_PREFIX to UPLOAD_FOLDER, like:
+
+                location /protected-uploads/ {
+                    internal;
+                    alias /vagrant/catalog/uploads/;
+                }
+
+    With the last two, the file does not go through a Python worker.
+
+    The python backend does not check that the file exists first: opening
+    it fails if it does not, and send_file stats the open file once.
+
+    Raises:
+      NotFound: if the file does not exist.
+    """
+    backend = app.config['IMAGE_SERVING']
+    if backend == 'python':
+        try:
+            return send_file(path, conditional = True)
+        except (IOError, OSError):
+            abort(404)
+
+    if not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = Response(mimetype = mimetype)
+    if backend == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    elif backend == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, app.config['UPLOAD_FOLDER'])
+        response.headers['X-Accel-Redirect'] = \
+            app.config['X_ACCEL_REDIRECT_PREFIX'] + relative_path.replace(os.sep, '/')
+    else:
+        raise ValueError("Unknown image serving backend: %r" % backend)
+    return response
+
+def remove_image(filename):
+    """Remove a reference to an image.
+
+    When there are no references left, a job is queued to remove its files.
+    """
+    db.query(ImageFile).filter_by(name = filename) \
+        .update({'ref_count': ImageFile.ref_count - 1}, synchronize_session = False)
+    unreferenced = db.query(ImageFile).filter_by(name = filename) \
+        .filter(ImageFile.ref_count <= 0).delete(synchronize_session = False)
+    # images uploaded before content addressing are not reference counted
+    if unreferenced or not is_content_addressed(filename):
+        enqueue('delete_image', filename = filename)
+
+def recount_image_references():
+    """Set the reference counts of all images to the number of items and
+    finalized uploads using them.
+
+    This is for items written without save_image and remove_image, like
+    the ones replaced or loaded by the bulk loader. Images left without
+    references get a job to remove their files. The changes are added to
+    the current database session.
+    """
+    files = ImageFile.__table__
+    items = Item.__table__
+    uploads = ImageUpload.__table__
+
+    new_images = db.execute(select([items.c.image]).distinct()
+        .where(and_(items.c.image != None, ~items.c.image.in_(select([files.c.name])))))
+    new_images = [image for (image,) in new_images if is_content_addressed(image)]
+    if new_images:
+        db.execute(files.insert(), [dict(name = image, ref_count = 0) for image in new_images])
+
+    item_count = select([func.count()]).where(items.c.image == files.c.name).as_scalar()
+    upload_count = select([func.count()]).where(uploads.c.image == files.c.name).as_scalar()
+    db.execute(files.update().values(ref_count = item_count + upload_count))
+
+    unreferenced = db.execute(select([files.c.name]).where(files.c.ref_count <= 0)).fetchall()
+    db.execute(files.delete().where(files.c.ref_count <= 0))
+    for (image,) in unreferenced:
+        enqueue('delete_image', filename = image)
+
+
+################################################################################
+# Jobs
+################################################################################
+
+@job_handler('process_image')
+def process_image(filename):
+    """Make the size variants of an uploaded image, and remove the upload."""
+    path = image_path(filename)
+    if not os.path.exists(path):
+        variants = [image_path(variant_filename(filename, size))
+            for size in app.config['IMAGE_SIZES']]
+        if not any(os.path.exists(p) for p in variants) and \
+                db.query(ImageFile).filter_by(name = filename).first() is not None:
+            # the request that stored it has not moved it into the store yet
+            raise IOError("Image %s is not stored yet" % filename)
+        # already processed, or the image was deleted
+        return
+    image = Image.open(path)
+    image.load()
+    if has_transparency(image):
+        image, image_format = image.convert('RGBA'), 'PNG'
+    else:
+        image, image_format = image.convert('RGB'), 'JPEG'
+
+    for size, dimensions in app.config['IMAGE_SIZES'].items():
+        variant = image.copy()
+        variant.thumbnail(dimensions, Image.ANTIALIAS)
+        variant_path = image_path(variant_filename(filename, size))
+        # write to a temporary file first, so a variant is never served half written
+        variant.save(variant_path + '.tmp', image_format, quality = JPEG_QUALITY, optimize = True)
+        os.rename(variant_path + '.tmp', variant_path)
+    os.remove(path)
+
+@job_handler('delete_image')
+def delete_image(filename):
+    """Remove all files of an image, unless it is still referenced."""
+    # checked under the lock, so a new upload of the image that commits in
+    # the meantime is moved into the store after its files are removed
+    with locked_images():
+        if db.query(ImageFile).filter_by(name = filename).first() is not None:
+            return
+        for name in image_filenames(filename):
+            path = image_path(name)
+            if os.path.exists(path):
+                os.remove(path)
+
+@job_handler('expire_image_upload')
+def expire_image_upload(upload_id):
+    """Remove a resumable upload that was not claimed, with its data."""
+    upload = db.query(ImageUpload).filter_by(id = upload_id).first()
+    if upload is not None:
+        if upload.image is not None:
+            remove_image(upload.image)
+        db.delete(upload)
+    path = upload_path(upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+@job_handler('cleanup_orphaned_images')
+def cleanup_orphaned_images():
+    """Remove files in UPLOAD_FOLDER that do not belong to any item."""
+    referenced = set([IMAGES_LOCK_FILE])
+    for (image,) in db.query(Item.image).filter(Item.image != None).yield_per(1000):
+        referenced.update(image_filenames(image))
+    for (image,) in db.query(ImageFile.name).yield_per(1000):
+        referenced.update(image_filenames(image))
+    # uploads in progress are removed when they expire
+    for (upload_id,) in db.query(ImageUpload.id).yield_per(1000):
+        referenced.add(os.path.basename(upload_path(upload_id)))
+
+    oldest = time.time() - ORPHAN_GRACE_PERIOD
+    for folder, subfolders, names in os.walk(app.config['UPLOAD_FOLDER']):
+        for name in names:
+            path = os.path.join(folder, name)
+            if name not in referenced and os.path.getmtime(path) < oldest:
+                os.remove(path)
+
+@app.before_first_request
+def schedule_orphaned_images_cleanup():
+    """Queue a cleanup of orphaned images when the server starts."""
+    pending = db.query(Job.id) \
+        .filter(Job.kind == 'cleanup_orphaned_images', Job.status == 'pending').first()
+    if pending is None:
+        enqueue('cleanup_orphaned_images')
+        db.commit()
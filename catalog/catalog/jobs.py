@@ -0,0 +1,218 @@
+"""Background jobs.
+
+Slow work, like processing uploaded images, is queued as a job and run by
+worker threads, off the request path. Jobs are stored in the jobs table,
+so pending jobs survive server restarts, and several server processes can
+share the queue.
+
+Usage:
+
+    @job_handler('send_mail')
+    def send_mail(to, subject):
+        ...
+
+    enqueue('send_mail', to = 'someone@example.com', subject = 'Hello')
+    db.commit()
+
+A job is added to the current database session, so it is only queued if
+the session is committed. Failed jobs are retried with increasing delays,
+up to JOB_MAX_ATTEMPTS times. Finished and failed jobs are kept for
+JOB_RETENTION_DAYS days, and then removed by the purge_jobs job. Handlers
+registered with secret_payload = True (for example, jobs with an access
+token in their arguments) have their payload removed as soon as the job
+is done or failed.
+"""
+
+import json
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from catalog import app
+from catalog import db
+from catalog import DBSession
+from catalog.models import Job
+
+
+logger = logging.getLogger(__name__)
+
+# Job handlers, by kind
+handlers = {}
+
+# Kinds of jobs whose payload is removed when they are done or failed
+secret_payload_kinds = set()
+
+# Set when new jobs are committed, to wake up the workers
+jobs_available = threading.Event()
+
+
+################################################################################
+# Queueing jobs
+################################################################################
+
+def job_handler(kind, secret_payload = False):
+    """Decorates a function to register it as the handler of a kind of job.
+
+    Args:
+      kind: kind of job.
+      secret_payload: remove the payload of the jobs when they are done or
+        failed, so that secrets in it are not kept in the jobs table.
+    """
+    def decorator(func):
+        handlers[kind] = func
+        if secret_payload:
+            secret_payload_kinds.add(kind)
+        return func
+    return decorator
+
+def enqueue(kind, delay = 0, **payload):
+    """Add a job to the current database session.
+
+    Args:
+      kind: kind of job, see job_handler.
+      delay: seconds to wait before running the job.
+      payload: arguments for the job handler. They must be JSON serializable.
+    Returns:
+      The new job.
+    """
+    job = Job(kind = kind,
+        payload = json.dumps(payload),
+        run_after = datetime.utcnow() + timedelta(seconds = delay))
+    db.add(job)
+    db.info['jobs_enqueued'] = True
+    return job
+
+@event.listens_for(DBSession, 'after_commit')
+def wake_workers(session):
+    """Wake up the workers when jobs are committed."""
+    if session.info.pop('jobs_enqueued', False):
+        jobs_available.set()
+
+
+################################################################################
+# Running jobs
+################################################################################
+
+def claim_job():
+    """Claim the next pending job for this worker.
+
+    Jobs are claimed with a conditional UPDATE, so that only one worker (in
+    any process) runs each job.
+
+    Returns:
+      The claimed job, or None if there are no pending jobs.
+    """
+    while True:
+        now = datetime.utcnow()
+        job = db.query(Job) \
+            .filter(Job.status == 'pending', Job.run_after <= now) \
+            .order_by(Job.run_after, Job.id).first()
+        if job is None:
+            db.rollback()
+            return None
+        claimed = db.query(Job) \
+            .filter(Job.id == job.id, Job.status == 'pending') \
+            .update({'status': 'running', 'attempts': Job.attempts + 1, 'updated': now},
+                synchronize_session = False)
+        db.commit()
+        if claimed:
+            db.refresh(job)
+            return job
+
+def release_stale_jobs():
+    """Make jobs that have been running for too long pending again.
+
+    This recovers jobs from workers that died while running them.
+    """
+    stale = datetime.utcnow() - timedelta(seconds = app.config['JOB_TIMEOUT'])
+    db.query(Job) \
+        .filter(Job.status == 'running', Job.updated < stale) \
+        .update({'status': 'pending'}, synchronize_session = False)
+    db.commit()
+
+def run_job(job):
+    """Run a claimed job, and record the outcome."""
+    try:
+        handlers[job.kind](**json.loads(job.payload))
+    except Exception:
+        db.rollback()
+        job.error = traceback.format_exc()
+        if job.attempts < app.config['JOB_MAX_ATTEMPTS']:
+            # retry after 2, 4, 8... seconds
+            job.status = 'pending'
+            job.run_after = datetime.utcnow() + timedelta(seconds = 2 ** job.attempts)
+            logger.warning("Job %d (%s) failed, will retry", job.id, job.kind)
+        else:
+            job.status = 'failed'
+            logger.error("Job %d (%s) failed:\n%s", job.id, job.kind, job.error)
+    else:
+        job.status = 'done'
+        job.error = None
+    if job.status != 'pending' and job.kind in secret_payload_kinds:
+        job.payload = '{}'
+    db.commit()
+
+def run_pending_jobs():
+    """Run pending jobs until there are none left."""
+    try:
+        while True:
+            job = claim_job()
+            if job is None:
+                return
+            run_job(job)
+    finally:
+        db.remove()
+
+def worker():
+    """Worker thread main loop."""
+    while True:
+        try:
+            release_stale_jobs()
+            run_pending_jobs()
+        except Exception:
+            logger.exception("Job worker error")
+            db.remove()
+        jobs_available.wait(app.config['JOB_POLL_INTERVAL'])
+        jobs_available.clear()
+
+workers = []
+
+def start_workers():
+    """Start the worker threads (JOB_WORKERS), if not started yet."""
+    if workers:
+        return
+    for i in range(app.config['JOB_WORKERS']):
+        thread = threading.Thread(target = worker, name = "job-worker-%d" % i)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+@app.before_first_request
+def start_workers_with_app():
+    start_workers()
+
+
+################################################################################
+# Purging old jobs
+################################################################################
+
+@job_handler('purge_jobs')
+def purge_jobs():
+    """Remove finished and failed jobs older than JOB_RETENTION_DAYS, and
+    schedule the next purge."""
+    oldest = datetime.utcnow() - timedelta(days = app.config['JOB_RETENTION_DAYS'])
+    db.query(Job).filter(Job.status.in_(['done', 'failed']), Job.updated < oldest) \
+        .delete(synchronize_session = False)
+    enqueue('purge_jobs', delay = app.config['JOB_PURGE_INTERVAL'])
+
+@app.before_first_request
+def schedule_jobs_purge():
+    """Queue a purge of old jobs when the server starts."""
+    pending = db.query(Job.id) \
+        .filter(Job.kind == 'purge_jobs', Job.status == 'pending').first()
+    if pending is None:
+        enqueue('purge_jobs')
+        db.commit()
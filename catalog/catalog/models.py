@@ -5,8 +5,8 @@ from flask import jsonify
 from flask import session as login_session
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, String, DateTime
+from sqlalchemy import Column, ForeignKey, Index
+from sqlalchemy import Integer, String, Text, DateTime
 from sqlalchemy.orm import relationship
 
 
@@ -36,7 +36,7 @@ class User(Base):
 
     id = Column(Integer, primary_key = True)
     name = Column(String(256), nullable = False)
-    email = Column(String(256), nullable = False)
+    email = Column(String(256), nullable = False, unique = True, index = True)
     picture = Column(String)
 
     @property
@@ -102,6 +102,11 @@ class Item(Base):
             The user who created this item.
     """
     __tablename__ = "items"
+    __table_args__ = (
+        # category page and user profile list items sorted by name
+        Index('ix_items_category_id_name', 'category_id', 'name'),
+        Index('ix_items_user_id_name', 'user_id', 'name'),
+    )
 
     id = Column(Integer, primary_key = True)
     name = Column(String(120), nullable = False)
@@ -129,5 +134,149 @@ class Item(Base):
             'user_id'       : self.user_id
         }
 
+# latest items and atom feed are sorted by most recent update
+Index('ix_items_updated_desc', Item.updated.desc())
+
+
+class DeletedItem(Base):
+    """Tombstone for a deleted item.
+
+    Clients that mirror the catalog use these to find out which items
+    were removed since they last synced.
+
+    Attributes:
+        id (Integer):
+            Tombstone ID.
+        item_id (Integer):
+            ID of the deleted item.
+        category_id (Integer):
+            ID of the category the item belonged to.
+        deleted (DateTime):
+            Date and time when the item was deleted.
+    """
+    __tablename__ = "deleted_items"
+
+    id = Column(Integer, primary_key = True)
+    item_id = Column(Integer, nullable = False)
+    category_id = Column(Integer, nullable = False)
+    deleted = Column(DateTime, default = datetime.utcnow, nullable = False, index = True)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format."""
+        return {
+            'item_id'       : self.item_id,
+            'category_id'   : self.category_id,
+            'deleted'       : self.deleted.isoformat()
+        }
+
+
+class ImageFile(Base):
+    """Stored image file, shared by all items with the same image.
+
+    See catalog/images.py.
+
+    Attributes:
+        name (String):
+            Image name (content hash and extension).
+        ref_count (Integer):
+            Number of items using this image.
+        created (DateTime):
+            Date and time when the image was first uploaded.
+    """
+    __tablename__ = "image_files"
+
+    name = Column(String(80), primary_key = True)
+    ref_count = Column(Integer, nullable = False, default = 0)
+    created = Column(DateTime, default = datetime.utcnow)
+
+
+class ImageUpload(Base):
+    """Resumable image upload in progress.
+
+    The uploaded data is appended to a partial file in UPLOAD_FOLDER, whose
+    size is the offset of the next chunk. See catalog/images.py.
+
+    Attributes:
+        id (String):
+            Upload ID (random hex string).
+        user_id (Integer):
+            ID of the user uploading the image.
+        image (String):
+            Name of the stored image, once the upload is finalized.
+        created (DateTime):
+            Date and time when the upload was started.
+    """
+    __tablename__ = "image_uploads"
+
+    id = Column(String(32), primary_key = True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable = False)
+    image = Column(String(80))
+    created = Column(DateTime, default = datetime.utcnow, nullable = False)
+
+
+class StoredSession(Base):
+    """Session stored on the server, when SESSION_STORE is "database".
+
+    See catalog/sessions.py.
+
+    Attributes:
+        id (String):
+            Session ID, which is the value of the session cookie.
+        data (Text):
+            Session data, in tagged JSON format.
+        expires (DateTime):
+            The session is removed after this date and time.
+    """
+    __tablename__ = "sessions"
+
+    id = Column(String(64), primary_key = True)
+    data = Column(Text, nullable = False)
+    expires = Column(DateTime, nullable = False, index = True)
+
+
+class Job(Base):
+    """Background job, run by the workers in catalog/jobs.py.
+
+    Jobs are stored in the database, so they are not lost when the server
+    restarts before they run.
+
+    Attributes:
+        id (Integer):
+            Job ID.
+        kind (String):
+            Name of the job handler that runs this job.
+        payload (Text):
+            Job arguments, in JSON format.
+        status (String):
+            One of "pending", "running", "done" or "failed".
+        attempts (Integer):
+            Number of times the job was started.
+        error (Text):
+            Error message of the last failed attempt.
+        run_after (DateTime):
+            The job does not run before this date and time.
+        created (DateTime):
+            Date and time when job was created.
+        updated (DateTime):
+            Date and time of last status change.
+    """
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # workers look for the next pending job
+        Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    id = Column(Integer, primary_key = True)
+    kind = Column(String(64), nullable = False)
+    payload = Column(Text, nullable = False)
+    status = Column(String(16), nullable = False, default = 'pending')
+    attempts = Column(Integer, nullable = False, default = 0)
+    error = Column(Text)
+
+    run_after = Column(DateTime, nullable = False, default = datetime.utcnow)
+    created = Column(DateTime, default = datetime.utcnow)
+    updated = Column(DateTime, default = datetime.utcnow, onupdate = datetime.utcnow)
+
 
 ################################################################################
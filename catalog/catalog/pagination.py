@@ -0,0 +1,171 @@
+"""Keyset (cursor based) pagination for SQLAlchemy queries.
+
+Instead of skipping rows with OFFSET, each page starts right after (or
+before) the sort key of the last row seen, so every page costs the same
+as the first one when the sort columns are indexed.
+
+The position in the result set is passed around as an opaque cursor
+string, which encodes the sort key values of a row.
+"""
+
+import base64
+import json
+
+from sqlalchemy import and_, or_
+
+
+################################################################################
+# Cursors
+################################################################################
+
+def encode_cursor(values):
+    """Encode a list of sort key values as an opaque, URL safe string."""
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor):
+    """Decode a cursor created with encode_cursor.
+
+    Raises:
+      ValueError: if the cursor is not valid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    for value in values:
+        # sort key values are plain scalars, anything else is a forged cursor
+        if value is not None and not isinstance(value, (basestring, int, long, float)):
+            raise ValueError("Invalid cursor: %r" % cursor)
+    return values
+
+
+# JSON types accepted in cursors for columns of each Python type
+CURSOR_VALUE_TYPES = {
+    int: (int, long),
+    long: (int, long),
+    float: (int, long, float),
+    str: basestring,
+    unicode: basestring,
+    bool: bool,
+}
+
+def check_cursor_values(columns, values, cursor):
+    """Check that cursor values have the types of their sort columns.
+
+    Otherwise a forged cursor would compare, for example, an integer column
+    to a string, which some databases reject with an error.
+
+    Raises:
+      ValueError: if a value does not match the type of its column.
+    """
+    for column, value in zip(columns, values):
+        if value is None:
+            continue
+        python_type = column.type.python_type
+        value_types = CURSOR_VALUE_TYPES.get(python_type, python_type)
+        if not isinstance(value, value_types) or \
+                (isinstance(value, bool) and python_type is not bool):
+            raise ValueError("Invalid cursor: %r" % cursor)
+
+
+################################################################################
+# Pagination
+################################################################################
+
+def keyset_filter(columns, values, reverse = False):
+    """Build a filter for rows sorted after the given sort key values.
+
+    For columns (a, b) and values (x, y) this is: a > x OR (a = x AND b > y).
+    If reverse is True, it selects the rows sorted before the values instead.
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        if reverse:
+            clauses.append(and_(*(equal + [column < values[i]])))
+        else:
+            clauses.append(and_(*(equal + [column > values[i]])))
+    return or_(*clauses)
+
+
+class Page(object):
+    """A page of query results.
+
+    Attributes:
+        items (list):
+            The rows in this page, in sort order.
+        next_cursor (String):
+            Cursor for the next page, or None if this is the last page.
+        prev_cursor (String):
+            Cursor for the previous page, or None if this is the first page.
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def paginate(query, columns, per_page, after = None, before = None, key = None):
+    """Get one page of a query, sorted in ascending order of columns.
+
+    The columns must uniquely identify a row (end them with the primary
+    key), otherwise rows with the same sort key may be skipped.
+
+    Args:
+      query: the query to paginate. It must not be sorted or limited yet.
+      columns: list of columns to sort by.
+      per_page: maximum number of rows in the page.
+      after: cursor of the row right before the page (for the next page).
+      before: cursor of the row right after the page (for the previous page).
+      key: function that returns the sort key values of a row.
+        By default, the column attributes of the row are used.
+    Returns:
+      A Page.
+    Raises:
+      ValueError: if a cursor is not valid, or its values do not have the
+        types of the columns.
+    """
+    if key is None:
+        key = lambda row: [getattr(row, c.key) for c in columns]
+
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ValueError("Invalid cursor: %r" % cursor)
+        check_cursor_values(columns, values, cursor)
+        query = query.filter(keyset_filter(columns, values, reverse = backwards))
+
+    if backwards:
+        query = query.order_by(*[c.desc() for c in columns])
+    else:
+        query = query.order_by(*columns)
+
+    # fetch an extra row to know if there are more rows after this page
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    first_cursor = encode_cursor(key(items[0])) if items else None
+    last_cursor = encode_cursor(key(items[-1])) if items else None
+    if backwards:
+        return Page(items,
+            next_cursor = last_cursor,
+            prev_cursor = first_cursor if has_more else None)
+    return Page(items,
+        next_cursor = last_cursor if has_more else None,
+        prev_cursor = first_cursor if cursor is not None else None)
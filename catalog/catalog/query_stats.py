@@ -0,0 +1,102 @@
+"""Per-request SQL query statistics.
+
+Every query run by the database engine is counted and timed, and the
+totals of each request are:
+
+    - sent in a Server-Timing header (if SERVER_TIMING is set), which
+      browser developer tools show next to the request timings.
+    - shown in a footer of each page, with the statements themselves
+      (if QUERY_STATS_FOOTER is set). See templates/_query_stats.html.
+
+Queries slower than SLOW_QUERY_THRESHOLD seconds are logged, with the
+endpoint that ran them, whether or not they run in a request.
+
+Queries run while a streamed response is sent are not included in the
+header, which is sent before them.
+"""
+
+import logging
+import time
+
+from flask import g
+from flask import has_request_context
+from flask import request
+
+from sqlalchemy import event
+
+from catalog import app
+from catalog import engine
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats(object):
+    """Queries run in a request.
+
+    Attributes:
+        count (int):
+            Number of queries.
+        duration (float):
+            Total time spent in queries, in seconds.
+        queries (list):
+            (statement, duration) tuples, if QUERY_STATS_FOOTER is set.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = []
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if app.config['QUERY_STATS_FOOTER']:
+            self.queries.append((statement, duration))
+
+
+def get_query_stats():
+    """Get the query statistics of the current request, or None outside requests."""
+    if not has_request_context():
+        return None
+    return g.get('query_stats')
+
+
+################################################################################
+# Engine and request hooks
+################################################################################
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start_time'].pop()
+    stats = get_query_stats()
+    if stats is not None:
+        stats.add(statement, duration)
+    if duration > app.config['SLOW_QUERY_THRESHOLD']:
+        endpoint = request.endpoint if has_request_context() else None
+        logger.warning("Slow query (%.1f ms) in %s:\n%s",
+            duration * 1000, endpoint or "background job", statement)
+
+@app.before_request
+def start_request_stats():
+    g.request_start_time = time.time()
+    g.query_stats = QueryStats()
+
+@app.after_request
+def add_server_timing_header(response):
+    """Add the query count and times to the response, in a Server-Timing header."""
+    stats = g.get('query_stats')
+    if stats is not None and app.config['SERVER_TIMING']:
+        total = time.time() - g.request_start_time
+        response.headers.add('Server-Timing',
+            'db;desc="%d queries";dur=%.1f, total;dur=%.1f' %
+            (stats.count, stats.duration * 1000, total * 1000))
+    return response
+
+@app.context_processor
+def query_stats_processor():
+    return dict(get_query_stats = get_query_stats)
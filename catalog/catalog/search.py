@@ -0,0 +1,178 @@
+"""Full-text search of items.
+
+Items are searched by name and description, and ranked by relevance,
+with matches in the name ranked higher.
+
+The search index depends on the database:
+
+    postgresql: a tsvector column in the items table, kept up to date by
+        a trigger, with a GIN index.
+    sqlite: an FTS5 table, kept up to date by triggers.
+    others: no index, a slow and unranked LIKE search.
+
+The index is created by setup_search, which is called by database_setup.py
+and migrate_database.py.
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import func
+from sqlalchemy.sql import column, literal_column, table, text
+
+from catalog.models import Item
+
+
+################################################################################
+# Index setup
+################################################################################
+
+POSTGRESQL_SEARCH_FUNCTION = """
+CREATE OR REPLACE FUNCTION items_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+POSTGRESQL_SEARCH_TRIGGER = """
+CREATE TRIGGER items_search_vector_update
+    BEFORE INSERT OR UPDATE OF name, description ON items
+    FOR EACH ROW EXECUTE PROCEDURE items_search_vector_update()
+"""
+
+SQLITE_SEARCH_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts
+    USING fts5(name, description, content='items', content_rowid='id')
+"""
+
+SQLITE_SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO items_fts(rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+    END
+    """,
+]
+
+def setup_search(engine):
+    """Create the search index for the items table, if it does not exist."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            columns = [c['name'] for c in inspector.get_columns('items')]
+            if 'search_vector' not in columns:
+                connection.execute("ALTER TABLE items ADD COLUMN search_vector tsvector")
+            connection.execute(POSTGRESQL_SEARCH_FUNCTION)
+            connection.execute("DROP TRIGGER IF EXISTS items_search_vector_update ON items")
+            connection.execute(POSTGRESQL_SEARCH_TRIGGER)
+            if 'search_vector' not in columns:
+                # fill in the column for existing items
+                connection.execute("UPDATE items SET name = name")
+            indexes = [i['name'] for i in inspector.get_indexes('items')]
+            if 'ix_items_search_vector' not in indexes:
+                connection.execute(
+                    "CREATE INDEX ix_items_search_vector ON items USING gin(search_vector)")
+        elif engine.dialect.name == 'sqlite':
+            new_table = 'items_fts' not in inspector.get_table_names()
+            connection.execute(SQLITE_SEARCH_TABLE)
+            for trigger in SQLITE_SEARCH_TRIGGERS:
+                connection.execute(trigger)
+            if new_table:
+                # index existing items
+                connection.execute("INSERT INTO items_fts(items_fts) VALUES ('rebuild')")
+
+
+################################################################################
+# Search
+################################################################################
+
+def fts5_query(terms):
+    """Convert search terms to an FTS5 query matching all of them.
+
+    Each word is quoted, so that FTS5 operators in the terms are ignored.
+    """
+    words = terms.split()
+    return " ".join('"%s"' % w.replace('"', '""') for w in words)
+
+def search_items(session, terms, limit, offset = 0):
+    """Search items by name and description.
+
+    Args:
+      session: database session.
+      terms: search terms. Items must match all terms.
+      limit: maximum number of items to return.
+      offset: number of items to skip.
+    Returns:
+      A list of items, most relevant first.
+    """
+    if not terms.split():
+        return []
+
+    query = session.query(Item)
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        tsquery = func.plainto_tsquery('english', terms)
+        search_vector = literal_column('items.search_vector')
+        query = query.filter(search_vector.op('@@')(tsquery)) \
+            .order_by(func.ts_rank(search_vector, tsquery).desc(), Item.id)
+    elif dialect == 'sqlite':
+        items_fts = table('items_fts', column('rowid'))
+        query = query.join(items_fts, items_fts.c.rowid == Item.id) \
+            .filter(text("items_fts MATCH :terms").bindparams(terms = fts5_query(terms))) \
+            .order_by(text("bm25(items_fts, 10.0, 1.0)"), Item.id)
+    else:
+        for word in terms.split():
+            pattern = '%' + word + '%'
+            query = query.filter(or_(Item.name.ilike(pattern), Item.description.ilike(pattern)))
+        query = query.order_by(Item.name, Item.id)
+    return query.limit(limit).offset(offset).all()
+
+def parse_search_args(args):
+    """Get the search terms and page number from request arguments.
+
+    Request arguments:
+        q:
+            Search terms.
+        page:
+            Page number, starting at 1.
+    Returns:
+      A tuple (terms, page).
+    Raises:
+      ValueError: if the page number is not valid.
+    """
+    terms = args.get('q', '')
+    page = int(args.get('page', 1))
+    if page < 1:
+        raise ValueError("Invalid page number: %r" % page)
+    return terms, page
+
+def search_page(session, terms, page, per_page):
+    """Get one page of search results.
+
+    Args:
+      session: database session.
+      terms: search terms.
+      page: page number, starting at 1.
+      per_page: number of items per page.
+    Returns:
+      A tuple (items, has_next).
+    """
+    items = search_items(session, terms, per_page + 1, (page - 1) * per_page)
+    return items[:per_page], len(items) > per_page
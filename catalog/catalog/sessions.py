@@ -0,0 +1,236 @@
+"""Server-side sessions.
+
+By default, Flask stores the whole session in a signed cookie, which the
+browser sends with every request, and which is verified and decoded on
+every request. The SESSION_STORE config setting can move the session data
+to the server instead, leaving only a random session ID in the cookie:
+
+    cookie: signed cookie sessions, the Flask default.
+    memory: sessions in a dict in the server process. They are lost when
+        the server restarts, and are not shared between processes, so this
+        is only for development and tests.
+    database: sessions in the sessions table.
+
+Server-side sessions expire PERMANENT_SESSION_LIFETIME after they were last
+saved. Sessions that are used without changes are saved again when half of
+that time has passed. Expired sessions are removed by a job, every
+SESSION_CLEANUP_INTERVAL seconds.
+"""
+
+import base64
+import os
+import threading
+from datetime import datetime
+
+from flask import session
+from flask.sessions import SessionInterface, SessionMixin
+from flask.sessions import SecureCookieSessionInterface, session_json_serializer
+
+from sqlalchemy import select
+
+from werkzeug.datastructures import CallbackDict
+
+from catalog import app
+from catalog import db
+from catalog import engine
+from catalog.jobs import enqueue, job_handler
+from catalog.models import Job, StoredSession
+
+
+################################################################################
+# Stores
+################################################################################
+
+class MemorySessionStore(object):
+    """Stores sessions in memory, in the server process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        """Get the (data, expires) of a session, or None if it does not exist."""
+        with self.lock:
+            return self.sessions.get(sid)
+
+    def save(self, sid, data, expires):
+        with self.lock:
+            self.sessions[sid] = (data, expires)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def delete_expired(self, now):
+        with self.lock:
+            for sid, (data, expires) in self.sessions.items():
+                if expires <= now:
+                    del self.sessions[sid]
+
+
+class DatabaseSessionStore(object):
+    """Stores sessions in the sessions table.
+
+    Sessions are read and written on their own connection, outside of the
+    request's database session, so that saving a session never commits
+    changes left by a view.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = StoredSession.__table__
+
+    def load(self, sid):
+        """Get the (data, expires) of a session, or None if it does not exist."""
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select([self.table.c.data, self.table.c.expires])
+                .where(self.table.c.id == sid)).first()
+        return tuple(row) if row is not None else None
+
+    def save(self, sid, data, expires):
+        with self.engine.begin() as connection:
+            updated = connection.execute(self.table.update()
+                .where(self.table.c.id == sid)
+                .values(data = data, expires = expires)).rowcount
+            if not updated:
+                connection.execute(self.table.insert()
+                    .values(id = sid, data = data, expires = expires))
+
+    def delete(self, sid):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.id == sid))
+
+    def delete_expired(self, now):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.expires <= now))
+
+
+################################################################################
+# Session interface
+################################################################################
+
+def new_session_id():
+    """Generate a random session ID (256 bits)."""
+    return base64.urlsafe_b64encode(os.urandom(32)).rstrip('=')
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose data is stored on the server.
+
+    Attributes:
+        sid (str):
+            Session ID, or None if the session is not stored yet.
+        expires (datetime):
+            When the stored session expires, or None if it is not stored yet.
+    """
+
+    def __init__(self, initial = None, sid = None, expires = None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+        self.regenerate_id = False
+
+    def regenerate(self):
+        """Move the session to a new ID, when it is saved."""
+        self.regenerate_id = True
+        self.modified = True
+
+class ServerSideSessionInterface(SessionInterface):
+    """Session interface that keeps session data in a store on the server."""
+
+    session_class = ServerSideSession
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            stored = self.store.load(sid)
+            if stored is not None:
+                data, expires = stored
+                if expires > datetime.utcnow():
+                    return self.session_class(self.serializer.loads(data), sid, expires)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.regenerate_id and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+
+        # Delete case: remove stored sessions that were emptied.
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                    domain = domain, path = path)
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        refresh = session.expires is not None and session.expires - now < lifetime / 2
+        if session.sid is None or session.modified or refresh:
+            if session.sid is None:
+                session.sid = new_session_id()
+            session.expires = now + lifetime
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), session.expires)
+        elif not self.should_set_cookie(app, session):
+            return
+
+        response.set_cookie(app.session_cookie_name, session.sid,
+            expires = self.get_expiration_time(app, session),
+            httponly = self.get_cookie_httponly(app),
+            domain = domain, path = path,
+            secure = self.get_cookie_secure(app))
+
+def create_session_interface(config):
+    """Create the session interface for the store selected in config."""
+    store = config['SESSION_STORE']
+    if store == 'cookie':
+        return SecureCookieSessionInterface()
+    if store == 'memory':
+        return ServerSideSessionInterface(MemorySessionStore())
+    if store == 'database':
+        return ServerSideSessionInterface(DatabaseSessionStore(engine))
+    raise ValueError("Unknown session store: %r" % store)
+
+app.session_interface = create_session_interface(app.config)
+
+def regenerate_session():
+    """Move the current session to a new ID, if it is stored on the server.
+
+    Call this when a user logs in, so that a session ID planted before the
+    login (session fixation) is not logged in.
+    """
+    current_session = session._get_current_object()
+    if isinstance(current_session, ServerSideSession):
+        current_session.regenerate()
+
+
+################################################################################
+# Jobs
+################################################################################
+
+@job_handler('cleanup_sessions')
+def cleanup_sessions():
+    """Remove expired sessions, and schedule the next cleanup."""
+    app.session_interface.store.delete_expired(datetime.utcnow())
+    enqueue('cleanup_sessions', delay = app.config['SESSION_CLEANUP_INTERVAL'])
+
+@app.before_first_request
+def schedule_sessions_cleanup():
+    """Queue a cleanup of expired sessions when the server starts."""
+    if not isinstance(app.session_interface, ServerSideSessionInterface):
+        return
+    pending = db.query(Job.id) \
+        .filter(Job.kind == 'cleanup_sessions', Job.status == 'pending').first()
+    if pending is None:
+        enqueue('cleanup_sessions')
+        db.commit()
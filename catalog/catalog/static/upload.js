@@ -0,0 +1,97 @@
+/*
+ * Resumable image uploads for the item forms.
+ *
+ * When the form is submitted with an image, the image is uploaded first,
+ * in chunks (see the resumable upload routes in views/api.py). If a chunk
+ * fails, the upload resumes from the offset the server got to. The form is
+ * then submitted with the upload ID instead of the file.
+ */
+$(function() {
+    var form = $('form[data-upload-url]');
+    if (!form.length || !window.Blob || !Blob.prototype.slice) {
+        return; // the image is uploaded with the form
+    }
+    var uploadUrl = form.data('upload-url');
+    var chunkSize = form.data('upload-chunk-size');
+    var maxRetries = 5;
+    var csrfToken = form.find('input[name=csrf_token]').val();
+    var fileInput = form.find('input[name=image]');
+    var uploadInput = form.find('input[name=image_upload]');
+    var submitButton = form.find('input[type=submit]');
+
+    function send(method, url, offset, data) {
+        var headers = {'X-CSRF-Token': csrfToken};
+        if (offset !== undefined) {
+            headers['Upload-Offset'] = offset;
+        }
+        return $.ajax({
+            type: method,
+            url: url,
+            headers: headers,
+            data: data,
+            processData: false,
+            contentType: 'application/offset+octet-stream',
+            dataType: 'json'
+        });
+    }
+
+    function upload(file, done, fail) {
+        var url;
+        var retries = 0;
+
+        function sendChunk(offset) {
+            if (offset >= file.size) {
+                send('POST', url + 'finalize/').then(function(upload) {
+                    done(upload.id);
+                }, fail);
+                return;
+            }
+            send('PATCH', url, offset, file.slice(offset, offset + chunkSize)).then(function(upload) {
+                retries = 0;
+                sendChunk(upload.offset);
+            }, resume);
+        }
+
+        function resume(xhr) {
+            // ask the server how much it got, and continue from there
+            if (xhr.status === 413 || retries++ >= maxRetries) {
+                fail(xhr);
+                return;
+            }
+            setTimeout(function() {
+                send('GET', url).then(function(upload) {
+                    sendChunk(upload.offset);
+                }, resume);
+            }, 1000 * retries);
+        }
+
+        send('POST', uploadUrl).then(function(upload) {
+            url = uploadUrl + upload.id + '/';
+            sendChunk(0);
+        }, fail);
+    }
+
+    // an upload left from a submission that failed validation is for the
+    // previous file
+    fileInput.on('change', function() {
+        uploadInput.val('');
+    });
+
+    form.on('submit', function(event) {
+        var file = fileInput[0].files && fileInput[0].files[0];
+        if (!file || uploadInput.val()) {
+            return;
+        }
+        event.preventDefault();
+        var label = submitButton.val();
+        submitButton.prop('disabled', true).val('Uploading image...');
+        upload(file, function(uploadId) {
+            uploadInput.val(uploadId);
+            fileInput.val('');
+            form[0].submit();
+        }, function(xhr) {
+            submitButton.prop('disabled', false).val(label);
+            alert(xhr.status === 413 ? 'The image is too big.' : 'The image could not be uploaded.');
+        });
+    });
+});
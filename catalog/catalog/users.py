@@ -1,5 +1,11 @@
 from flask import session as login_session
 
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import IntegrityError
+
+from werkzeug.contrib.cache import SimpleCache
+
+from catalog import app
 from catalog import db
 from catalog.models import User
 
@@ -8,25 +14,88 @@ from catalog.models import User
 # User functions
 ################################################################################
 
+# Recently used users, by email (user IDs) and by ID (detached User objects).
+# Each process has its own cache, so changes made by other processes may be
+# seen up to USER_CACHE_TIMEOUT seconds late.
+user_cache = SimpleCache(threshold = 1000, default_timeout = app.config['USER_CACHE_TIMEOUT'])
+
+def upsert_user(name, email, picture):
+    """Create a user, or update the name and picture of the user with that email.
+
+    On PostgreSQL this is a single INSERT ... ON CONFLICT ... RETURNING
+    query. The change is committed.
+
+    Returns:
+      The user ID.
+    """
+    if db.get_bind().dialect.name == 'postgresql':
+        insert = postgresql_insert(User.__table__) \
+            .values(name = name, email = email, picture = picture)
+        insert = insert.on_conflict_do_update(
+            index_elements = [User.email],
+            set_ = dict(name = insert.excluded.name, picture = insert.excluded.picture)) \
+            .returning(User.id)
+        user_id = db.execute(insert).scalar()
+        db.commit()
+    else:
+        user = db.query(User).filter_by(email = email).first()
+        if user is None:
+            user = User(name = name, email = email, picture = picture)
+        else:
+            user.name, user.picture = name, picture
+        db.add(user)
+        try:
+            db.flush()
+            user_id = user.id
+            db.commit()
+        except IntegrityError as e:
+            # created by a concurrent request
+            db.rollback()
+            user_id = get_user_id(email)
+            if user_id is None:
+                raise e
+
+    user_cache.set('email:' + email, user_id)
+    user_cache.delete('id:%d' % user_id)
+    return user_id
+
 def create_user(login_session):
-    newUser = User(
+    """Create (or update) the user logged in with login_session.
+
+    Returns:
+      The user ID.
+    """
+    return upsert_user(
         name = login_session['username'],
         email = login_session['email'],
         picture = login_session['picture'])
-    db.add(newUser)
-    db.commit()
-    user = db.query(User).filter_by(email = login_session['email']).one()
-    return user.id
 
 def get_user_id(email):
-    try:
-        user = db.query(User).filter_by(email = email).one()
-        return user.id
-    except:
-        return None
+    """Get the ID of the user with an email, or None if there is none."""
+    user_id = user_cache.get('email:' + email)
+    if user_id is None:
+        user = db.query(User.id).filter_by(email = email).first()
+        if user is None:
+            return None
+        user_id = user.id
+        user_cache.set('email:' + email, user_id)
+    return user_id
 
 def get_user_info(user_id):
-    user = db.query(User).filter_by(id=user_id).one()
-    return user
+    """Get a user, or None if there is none.
+
+    Returns:
+      The User, attached to the current session without a query if it
+      was cached.
+    """
+    user = user_cache.get('id:%d' % user_id)
+    if user is None:
+        user = db.query(User).filter_by(id = user_id).first()
+        if user is None:
+            return None
+        # the cache keeps a detached copy
+        user_cache.set('id:%d' % user_id, user)
+        return user
+    return db.merge(user, load = False)
 
 ################################################################################
@@ -18,13 +18,28 @@ from flask import render_template
 from flask import session
 from flask import url_for
 
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import NotFound
+
 from catalog import app
 from catalog import db
-from catalog.models import Base, User, Category, Item
+from catalog.models import Base, Category, Item, DeletedItem, ImageUpload
 from catalog.forms import CSRFForm
+from catalog.cache import invalidate
+from catalog.categories import get_categories
+from catalog.conditional import make_etag, conditional_response
 from catalog.forms.item import ItemForm
+from catalog.images import save_image, remove_image, send_image
+from catalog.images import image_path, is_content_addressed, variant_filename
+from catalog.images import create_upload, append_upload, finalize_upload, claim_upload
+from catalog.images import upload_offset, upload_path, UploadBusyError, UploadOffsetError
+from catalog.pagination import paginate
+from catalog.search import parse_search_args, search_page
+from catalog.users import get_user_info
 
 from auth import login_required
 
@@ -38,19 +53,60 @@ api = Blueprint('api', __name__)
 # Maximum number of recently created or modified items to show 
 LATEST_ITEMS_TO_SHOW = 10
 
-@api.route("/")
-@api.route("/catalog/")
-def view_catalog():
-    """Catalog homepage."""
-    categories = db.query(Category).all()
-    items = db.query(Item).order_by(Item.name).all()
-    latest_items = db.query(Item).order_by(Item.updated.desc()) \
+def load_catalog_homepage():
+    """Load all data needed by the catalog homepage.
+
+    The page always costs three queries, no matter how many categories
+    and items there are: one GROUP BY on items for the category item
+    counts, and one query each for all items and the latest items, with
+    the category of each item loaded in the same query. The categories
+    themselves come from the category cache.
+
+    Returns:
+      A dict with the template arguments for api/catalog.html:
+        categories: list of (CachedCategory, item count) tuples, sorted by name.
+        items: all items, sorted by name.
+        latest_items: the most recently created or modified items.
+    """
+    item_counts = dict(db.query(Item.category_id, func.count(Item.id))
+        .group_by(Item.category_id))
+    categories = [(c, item_counts.get(c.id, 0)) for c in get_categories()]
+    items = db.query(Item).join(Item.category) \
+        .options(contains_eager(Item.category)) \
+        .order_by(Item.name).all()
+    latest_items = db.query(Item).options(joinedload(Item.category)) \
+        .order_by(Item.updated.desc()) \
         .limit(LATEST_ITEMS_TO_SHOW).all()
-    return render_template("api/catalog.html", 
+    return dict(
         categories = categories,
         items = items,
         latest_items = latest_items)
 
+@api.route("/")
+@api.route("/catalog/")
+def view_catalog():
+    """Catalog homepage."""
+    return render_template("api/catalog.html", **load_catalog_homepage())
+
+
+def paginate_items(query):
+    """Get the page of items requested in the request arguments.
+
+    Items are sorted by name, using keyset pagination on (name, id).
+
+    Request arguments:
+        after:
+            Cursor of the last item in the previous page.
+        before:
+            Cursor of the first item in the next page.
+    """
+    try:
+        return paginate(query, [Item.name, Item.id],
+            per_page = app.config['ITEMS_PER_PAGE'],
+            after = request.args.get('after'),
+            before = request.args.get('before'))
+    except ValueError:
+        abort(400)
 
 @api.route("/catalog/category/<int:category_id>/")
 def view_category(category_id):
@@ -59,45 +115,95 @@ def view_category(category_id):
         category = db.query(Category).filter_by(id = category_id).one()
     except NoResultFound:
         abort(404)
-    items = db.query(Item).filter_by(category_id = category.id)
-    return render_template("api/category.html", category = category, items = items)
+    item_count, last_updated = db.query(func.count(Item.id), func.max(Item.updated)) \
+        .filter(Item.category_id == category.id).one()
+    etag = make_etag(category.id, category.name, item_count, last_updated,
+        session.get('user_id'))
+
+    def render():
+        page = paginate_items(db.query(Item).filter_by(category_id = category.id))
+        return render_template("api/category.html",
+            category = category,
+            item_count = item_count,
+            page = page)
+    # no Last-Modified: deleting or moving out an item does not raise it
+    return conditional_response(etag, None, render)
 
 
 @api.route("/catalog/item/<int:item_id>/")
 def view_item(item_id):
     """View a specific item."""
     try:
-        item = db.query(Item).filter_by(id = item_id).one()
+        item = db.query(Item) \
+            .options(joinedload(Item.category), joinedload(Item.user)) \
+            .filter_by(id = item_id).one()
     except NoResultFound:
         abort(404)
-    return render_template("api/item.html", item = item)
+    etag = make_etag(item.id, item.updated, item.category.name, item.user.name,
+        session.get('user_id'))
+    return conditional_response(etag, item.updated,
+        lambda: render_template("api/item.html", item = item))
+
+
+@api.route("/catalog/search/")
+def search():
+    """Search items by name and description."""
+    try:
+        terms, page = parse_search_args(request.args)
+    except ValueError:
+        abort(400)
+    items, has_next = search_page(db, terms, page, app.config['ITEMS_PER_PAGE'])
+    return render_template("api/search.html",
+        terms = terms,
+        items = items,
+        page = page,
+        has_next = has_next)
 
 
 ################################################################################
 # Create/edit/delete items
 ################################################################################
 
+def save_form_image(form):
+    """Save the image of an item form.
+
+    The image is either uploaded with the form, or uploaded before with a
+    resumable upload, whose ID is in the image_upload field. A file
+    uploaded with the form wins: the upload ID may be left over from an
+    earlier submission of the form, made before the user chose a new file.
+    An upload that is not claimed expires.
+
+    Returns:
+      The image name, or None if no image was uploaded.
+    Raises:
+      IOError: if the uploaded file is not a valid image.
+      ValueError: if the resumable upload is not valid.
+    """
+    form_file = request.files.get(form.image.name)
+    if form_file:
+        return save_image(form_file)
+    if form.image_upload.data:
+        return claim_upload(form.image_upload.data, session['user_id'])
+    return None
+
 @api.route("/catalog/item/new/", methods = ['GET', 'POST'])
 @login_required
 def new_item():
     """Create new item."""
     # populate form
     form = ItemForm(request.form)
-    categories = db.query(Category).order_by(Category.name).all() # sort alphabetically
-    form.category_id.choices = [(c.id, c.name) for c in categories]
+    form.category_id.choices = get_categories() # sorted alphabetically
 
     # display and validate form    
     if request.method != 'POST' or not form.validate():
         return render_template('api/new_item.html', form = form)
 
     # get image file
-    form_file = request.files[form.image.name]
-    img_filename = None
-    if form_file:
-        filename = secure_filename(form_file.filename)
-        filename = generate_unique_filename(filename)
-        form_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        img_filename = filename
+    try:
+        img_filename = save_form_image(form)
+    except (IOError, ValueError):
+        form.image.errors.append(u'Invalid image file.')
+        return render_template('api/new_item.html', form = form)
 
     # create item
     new_item = Item(
@@ -108,6 +214,7 @@ def new_item():
         user_id = session['user_id'])
     db.add(new_item)
     db.commit()
+    invalidate('items')
 
     flash(message = "Item successfully created", category = "success")
 
@@ -129,21 +236,18 @@ def edit_item(item_id):
 
     # populate form
     form = ItemForm(request.form, item)
-    categories = db.query(Category).order_by(Category.name).all() # sort alphabetically
-    form.category_id.choices = [(c.id, c.name) for c in categories]
+    form.category_id.choices = get_categories() # sorted alphabetically
 
     # display and validate form
     if request.method != 'POST' or not form.validate():
         return render_template('api/edit_item.html', form = form, item = item)
 
     # get image file
-    form_file = request.files[form.image.name]
-    img_filename = None
-    if form_file:
-        filename = secure_filename(form_file.filename)
-        filename = generate_unique_filename(filename)
-        form_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        img_filename = filename
+    try:
+        img_filename = save_form_image(form)
+    except (IOError, ValueError):
+        form.image.errors.append(u'Invalid image file.')
+        return render_template('api/edit_item.html', form = form, item = item)
 
     # edit item
     item.name = form.name.data
@@ -151,9 +255,12 @@ def edit_item(item_id):
     item.category_id = form.category_id.data
     # only replace image if new image is uploaded
     if img_filename:
+        if item.image:
+            remove_image(item.image)
         item.image = img_filename
     db.add(item)
     db.commit()
+    invalidate('items')
 
     flash(message = "Item successfully updated", category = "success")
 
@@ -180,9 +287,13 @@ def delete_item(item_id):
     if request.method != 'POST' or not form.validate():
         return render_template('api/delete_item.html', form = form, item = item)
 
-    # delete the item
+    # delete the item, leaving a tombstone for sync clients
+    db.add(DeletedItem(item_id = item.id, category_id = item.category_id))
+    if item.image:
+        remove_image(item.image)
     db.delete(item)
     db.commit()
+    invalidate('items')
 
     flash(message = "Item successfully removed", category = "success")
 
@@ -198,10 +309,13 @@ def delete_item(item_id):
 def user_profile():
     """View current user's profile page."""
     user_id = session["user_id"]
-    user = db.query(User).filter_by(id = user_id).one()
+    user = get_user_info(user_id)
+    if user is None:
+        abort(404)
     # sort user items alphabetically 
-    items = db.query(Item).filter_by(user_id = user_id).order_by(Item.name).all()
-    return render_template("api/user.html", user = user, items = items)
+    page = paginate_items(db.query(Item).filter_by(user_id = user_id)
+        .options(joinedload(Item.category)))
+    return render_template("api/user.html", user = user, page = page)
 
 
 ################################################################################
@@ -209,62 +323,139 @@ def user_profile():
 ################################################################################
 
 import os
-import datetime
-import string
-import random
-import uuid
-from werkzeug import secure_filename
-from flask import send_from_directory
 
-def generate_random_string():
-    """Generate a random string with alphabetic characters and digits."""
-    alpha = string.ascii_lowercase + string.ascii_uppercase + string.digits
-    rand_str = "".join(random.choice(alpha) for x in xrange(32))
-    return rand_str
+# Cache-Control header for images that never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
-def generate_unique_filename(original_filename):
-    """Generate a unique name for a file.
+@api.route("/image/<string:filename>/")
+@api.route("/image/<string:size>/<string:filename>/")
+def view_image(filename, size = 'full'):
+    """View uploaded image, in one of the sizes in IMAGE_SIZES.
 
-    The current implementation does not actually guarantee uniqueness,
-    but the probability of generating the same name twice is very low.
+    Images stored under their content hash never change, so their
+    variants are served with far-future cache headers.
+    """
+    if size not in app.config['IMAGE_SIZES']:
+        abort(404)
+    try:
+        response = send_image(image_path(variant_filename(filename, size)))
+    except NotFound:
+        # the variants are not made yet, or this image was uploaded before
+        # size variants were introduced: serve the original
+        return send_image(image_path(filename))
+    if is_content_addressed(filename):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+# Resumable uploads
+#
+# A browser uploads a large image in chunks, and then submits the item form
+# with the upload ID instead of the file (see static/upload.js):
+#
+#   POST   /image/uploads/                   start an upload
+#   PATCH  /image/uploads/<id>/              append a chunk, at the offset in
+#                                            the Upload-Offset header
+#   GET    /image/uploads/<id>/              get the current offset, to resume
+#   POST   /image/uploads/<id>/finalize/     store the image
+#
+# All requests need the form's CSRF token in the X-CSRF-Token header.
+
+def check_upload_csrf():
+    """Abort the request if it does not have a valid CSRF token."""
+    form = CSRFForm(MultiDict([('csrf_token', request.headers.get('X-CSRF-Token', ''))]))
+    if not form.validate():
+        abort(400)
+
+def load_upload(upload_id):
+    """Get an upload of the current user, or abort with 404."""
+    upload = db.query(ImageUpload) \
+        .filter_by(id = upload_id, user_id = session['user_id']).first()
+    if upload is None:
+        abort(404)
+    return upload
 
-    The generated file names include the date and time, and a random UUID.
+def upload_response(upload, offset, status = 200):
+    """JSON response with the state of an upload."""
+    response = jsonify(id = upload.id, offset = offset, image = upload.image)
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(offset)
+    return response
 
-    Args:
-      original_filename: the original name of the file.
-    Returns:
-      A file name with the same extension as the original file, and
-      which is almost surely unique.
-    """
-    # keep file extension, in lower case
-    ext = os.path.splitext(original_filename)[1].strip().lower()
+@api.route("/image/uploads/", methods = ['POST'])
+@login_required
+def start_image_upload():
+    """Start a resumable image upload."""
+    check_upload_csrf()
+    upload = create_upload(session['user_id'])
+    db.commit()
+    return upload_response(upload, 0, 201)
 
-    # current date and time
-    date_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+@api.route("/image/uploads/<string:upload_id>/", methods = ['GET', 'PATCH'])
+@login_required
+def image_upload(upload_id):
+    """Get the offset of a resumable upload, or append a chunk to it.
 
-    # generate random uuid
-    uuid_hex = uuid.uuid4().hex
+    The chunk is the request body, and is streamed to disk as it arrives.
+    An upload can not get bigger than MAX_CONTENT_LENGTH.
+    """
+    check_upload_csrf()
+    upload = load_upload(upload_id)
+    if request.method == 'GET':
+        return upload_response(upload, upload_offset(upload))
 
-    filename = "_".join([date_time, uuid_hex, ext])
-    return filename
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        abort(400)
+    length = request.content_length
+    if length is None:
+        abort(411)
+    if offset + length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
+    try:
+        offset = append_upload(upload, offset, request.stream, length)
+    except UploadOffsetError as e:
+        return upload_response(upload, e.offset, 409)
+    except UploadBusyError:
+        return upload_response(upload, upload_offset(upload), 409)
+    return upload_response(upload, offset)
+
+@api.route("/image/uploads/<string:upload_id>/finalize/", methods = ['POST'])
+@login_required
+def finalize_image_upload(upload_id):
+    """Store the image of a resumable upload.
 
+    The upload ID can then be submitted with the item form.
+    """
+    check_upload_csrf()
+    upload = load_upload(upload_id)
+    try:
+        offset = upload_offset(upload)
+        finalize_upload(upload)
+    except UploadBusyError:
+        return upload_response(upload, upload_offset(upload), 409)
+    except IOError:
+        # not an image: discard the upload, the client has to start over
+        db.delete(upload)
+        db.commit()
+        os.remove(upload_path(upload.id))
+        abort(400)
+    db.commit()
+    return upload_response(upload, offset)
 
-@api.route("/image/<string:filename>/")
-def view_image(filename):
-    """View uploaded image."""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
-def get_image_url(filename):
-    """Get URL for an image file.
+def get_image_url(filename, size = 'full'):
+    """Get URL for an image file, in one of the sizes in IMAGE_SIZES.
 
     If no file is specified, returns a URL for a place holder image.
 
     Note that this method does not check if the file actually exists.
     """
     if filename:
-        return url_for("api.view_image", filename = filename)
+        return url_for("api.view_image", filename = filename, size = size)
     else:
-        return "https://placehold.it/300x300.png?text=No+image"
+        return "https://placehold.it/%dx%d.png?text=No+image" % app.config['IMAGE_SIZES'][size]
 
 ################################################################################
 
@@ -1,7 +1,5 @@
 """This module includes routes and functions for authentication and authorization."""
 
-import httplib2
-import requests
 import json
 
 from flask import Blueprint
@@ -13,7 +11,9 @@ from flask import session as login_session
 from flask import url_for
 
 from catalog import app
-from catalog.users import get_user_id, get_user_info, create_user
+from catalog import db
+from catalog.sessions import regenerate_session
+from catalog.users import create_user
 
 auth = Blueprint('auth', __name__)
 
@@ -72,12 +72,9 @@ def login_required(func):
 from flask import request
 from flask import make_response
 
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
-from oauth2client.client import OAuth2Credentials
 
-import os
-from catalog import app_root
+from catalog.google_signin import exchange_code, get_token_info, get_user_profile, revoke_token_later
 
 @auth.route("/google_connect", methods = ["POST"])
 def google_connect():
@@ -88,9 +85,7 @@ def google_connect():
 
     # Upgrade the authorization code into a credentials object.
     try:
-        oauth_flow = flow_from_clientsecrets(os.path.join(app_root, 'client_secret_google.json'), scope = '')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        credentials = exchange_code(code)
     except FlowExchangeError:
         response = make_response(
             json.dumps('Failed to upgrade authorization code.'), 401)
@@ -99,9 +94,7 @@ def google_connect():
 
     # Check that the access token is valid. If there is an error in the token, abort.
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s' % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    result = get_token_info(access_token)
     if result.get('error') is not None:
         response = make_response(
             json.dumps(result.get('error')), 500)
@@ -133,15 +126,15 @@ def google_connect():
 
     # Everything OK. Now load user info and add store it in the session...
 
+    # Give a server-side session a new ID, so that an ID planted before the login is not logged in.
+    regenerate_session()
+
     # Store the access token in the session for later use.
     login_session['credentials'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
     # Get user info.
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    user_info = requests.get(userinfo_url, params = params)
-    data = user_info.json()
+    data = get_user_profile(credentials.access_token)
 
     # Store user info in session.
     login_session['provider'] = 'google'
@@ -149,14 +142,8 @@ def google_connect():
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
 
-    # see if user exists, if it doesn't make a new one
-    email = login_session['email']
-    user_id = get_user_id(email)
-    if not user_id:
-        user_id = create_user(login_session)
-        login_session['user_id'] = user_id
-    else:
-        login_session['user_id'] = user_id
+    # create the user, or update their name and picture if they exist
+    login_session['user_id'] = create_user(login_session)
 
     flash(message = "You are now logged in as %s" % login_session['username'], category = "success")
 
@@ -177,17 +164,13 @@ def google_disconnect():
             json.dumps('Current user not connected.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-
-    if result['status'] != '200':
-        # For whatever reason, the given token was invalid.
-        # No need to do anything. User is still logged out.
-        print "Failed to revoke access token. It may have been experired or invalid for another reason. User logged out."
+    # Revoke the token in the background. The user is logged out anyway.
+    revoke_token_later(access_token)
+    db.commit()
 
     # Reset the user's session.
     login_session.clear()
+    regenerate_session()
 
     flash(message = "You are now logged out.", category = "success")
     return redirect(url_for('api.view_catalog'))
@@ -3,13 +3,24 @@
 It includes endpoints for getting catalog data in JSON format, and Atom feeds.
 """
 
+from datetime import datetime, timedelta
+
 from flask import abort
 from flask import Blueprint
+from flask import request
 
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
+from catalog import app
 from catalog import db
-from catalog.models import User, Category, Item
+from catalog.cache import cache, make_key
+from catalog.conditional import make_etag, conditional_response
+from catalog.models import User, Category, Item, DeletedItem
+from catalog.pagination import paginate
+from catalog.pagination import encode_cursor, decode_cursor, keyset_filter
+from catalog.search import parse_search_args, search_page
 
 from auth import login_required
 
@@ -20,15 +31,47 @@ data = Blueprint('data', __name__)
 # JSON
 ################################################################################
 
+from flask import json
 from flask import jsonify
+from flask import Response
+from flask import stream_with_context
+
+# Number of rows fetched from the database, and encoded, at a time
+JSON_STREAM_CHUNK_SIZE = 1000
+
+def generate_json_array(query, chunk_size = JSON_STREAM_CHUNK_SIZE):
+    """Generate a JSON array with the serialized rows of a query, in chunks.
+
+    Rows are fetched from a server side cursor, chunk_size rows at a time,
+    so only one chunk of rows is held in memory.
+    """
+    yield '['
+    separator = ''
+    chunk = []
+    for row in query.yield_per(chunk_size):
+        chunk.append(separator + json.dumps(row.serialize))
+        separator = ', '
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk) + ']'
 
 @data.route('/catalog.json')
 def view_catalog_json():
-    """Catalog in json format."""
-    categories = db.query(Category).all()
-    items = db.query(Item).all()
-    return jsonify(categories = [c.serialize for c in categories],
-        items = [i.serialize for i in items])
+    """Catalog in json format.
+
+    The response is streamed, so that memory use does not grow with the size
+    of the catalog, and the client starts receiving data right away.
+    """
+    def generate():
+        yield '{"categories": '
+        for chunk in generate_json_array(db.query(Category).order_by(Category.id)):
+            yield chunk
+        yield ', "items": '
+        for chunk in generate_json_array(db.query(Item).order_by(Item.id)):
+            yield chunk
+        yield '}\n'
+    return Response(stream_with_context(generate()), mimetype = 'application/json')
 
 @data.route("/catalog/category-<int:category_id>.json")
 def view_category_json(category_id):
@@ -37,9 +80,16 @@ def view_category_json(category_id):
         category = db.query(Category).filter_by(id = category_id).one()
     except NoResultFound:
         abort(404)
-    items = db.query(Item).filter_by(category_id = category.id).all()
-    return jsonify(category = category.serialize,
-        items = [i.serialize for i in items])
+    item_count, last_updated = db.query(func.count(Item.id), func.max(Item.updated)) \
+        .filter(Item.category_id == category.id).one()
+    etag = make_etag(category.id, category.name, item_count, last_updated)
+
+    def render():
+        items = db.query(Item).filter_by(category_id = category.id).all()
+        return jsonify(category = category.serialize,
+            items = [i.serialize for i in items])
+    # no Last-Modified: deleting or moving out an item does not raise it
+    return conditional_response(etag, None, render)
 
 @data.route("/catalog/item-<int:item_id>.json")
 def view_item_json(item_id):
@@ -48,7 +98,202 @@ def view_item_json(item_id):
         item = db.query(Item).filter_by(id = item_id).one()
     except NoResultFound:
         abort(404)
-    return jsonify(item = item.serialize)
+    etag = make_etag(item.id, item.updated)
+    return conditional_response(etag, item.updated,
+        lambda: jsonify(item = item.serialize))
+
+# Number of items returned by /api/items, if no limit is given, and maximum limit
+API_ITEMS_DEFAULT_LIMIT = 100
+API_ITEMS_MAX_LIMIT = 1000
+
+# Item fields that can be selected in /api/items
+ITEM_FIELDS = ('id', 'name', 'description', 'image', 'category_id', 'user_id')
+
+def parse_datetime(value):
+    """Parse an ISO 8601 date and time (UTC), like 2016-05-01T10:30:00.
+
+    Raises:
+      ValueError: if the value is not a valid date and time.
+    """
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date and time: %r" % value)
+
+@data.route('/api/items')
+def api_items():
+    """Paginated list of items in json format, sorted by id.
+
+    Request arguments:
+        limit:
+            Maximum number of items to return (up to API_ITEMS_MAX_LIMIT).
+        cursor:
+            The next_cursor from a previous response, to get the next page.
+        category_id:
+            Only return items in this category.
+        updated_since:
+            Only return items updated at or after this date and time (UTC).
+        fields:
+            Comma separated list of item fields to return. Default: all.
+
+    The response includes next_cursor, which is null on the last page.
+    """
+    try:
+        limit = int(request.args.get('limit', API_ITEMS_DEFAULT_LIMIT))
+        category_id = request.args.get('category_id')
+        if category_id is not None:
+            category_id = int(category_id)
+        updated_since = request.args.get('updated_since')
+        if updated_since is not None:
+            updated_since = parse_datetime(updated_since)
+    except ValueError:
+        abort(400)
+    if limit < 1 or limit > API_ITEMS_MAX_LIMIT:
+        abort(400)
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = fields.split(',')
+        if any(f not in ITEM_FIELDS for f in fields):
+            abort(400)
+
+    query = db.query(Item)
+    if category_id is not None:
+        query = query.filter(Item.category_id == category_id)
+    if updated_since is not None:
+        query = query.filter(Item.updated >= updated_since)
+    try:
+        page = paginate(query, [Item.id], per_page = limit,
+            after = request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+    items = [i.serialize for i in page.items]
+    if fields:
+        items = [dict((f, i[f]) for f in fields) for i in items]
+    return jsonify(items = items, next_cursor = page.next_cursor)
+
+# Maximum number of changed items, and of deleted items, in /catalog/changes.json
+CHANGES_FEED_SIZE = 500
+
+def decode_changes_cursor(cursor):
+    """Decode a change feed cursor.
+
+    The cursor holds the (updated, id) of the last changed item seen and the
+    (deleted, id) of the last tombstone seen. Either pair may be None.
+
+    Raises:
+      ValueError: if the cursor is not valid.
+    """
+    values = decode_cursor(cursor)
+    if len(values) != 4:
+        raise ValueError("Invalid cursor: %r" % cursor)
+    item_key = values[0:2] if values[0] is not None else None
+    tombstone_key = values[2:4] if values[2] is not None else None
+    for key in item_key, tombstone_key:
+        if key is not None:
+            key[0] = parse_datetime(key[0])
+            if not isinstance(key[1], int):
+                raise ValueError("Invalid cursor: %r" % cursor)
+    return item_key, tombstone_key
+
+def encode_changes_cursor(item_key, tombstone_key):
+    """Encode a change feed cursor. See decode_changes_cursor."""
+    values = []
+    for key in item_key, tombstone_key:
+        if key is None:
+            values += [None, None]
+        else:
+            values += [key[0].isoformat(), key[1]]
+    return encode_cursor(values)
+
+@data.route('/catalog/changes.json')
+def view_changes_json():
+    """Items changed or deleted since the last sync, in json format.
+
+    Request arguments:
+        cursor:
+            The cursor from the previous response.
+            If not specified, the feed starts from the beginning.
+
+    The response includes:
+        changed: items created or updated since the cursor, oldest first.
+        deleted: tombstones of items deleted since the cursor, oldest first.
+        cursor: cursor to pass in the next request.
+        has_more: true if there are more changes to fetch right away.
+
+    Clients should apply the changed items before the deleted ones.
+
+    Items and tombstones are only listed once they are CHANGES_FEED_DELAY
+    seconds old. Their dates are set when they are written, not when the
+    transaction commits, so a slow transaction can commit changes dated
+    before ones that are listed already, and which the cursor has passed.
+    The delay leaves time for those to commit. Changes from transactions
+    that take longer than it (or from servers whose clocks are off by
+    more) can still be missed.
+    """
+    item_key = tombstone_key = None
+    if 'cursor' in request.args:
+        try:
+            item_key, tombstone_key = decode_changes_cursor(request.args['cursor'])
+        except ValueError:
+            abort(400)
+
+    # see only changes whose transactions have had time to commit
+    listed_until = datetime.utcnow() - timedelta(seconds = app.config['CHANGES_FEED_DELAY'])
+
+    items_query = db.query(Item).filter(Item.updated < listed_until)
+    if item_key is not None:
+        items_query = items_query.filter(keyset_filter([Item.updated, Item.id], item_key))
+    items = items_query.order_by(Item.updated, Item.id) \
+        .limit(CHANGES_FEED_SIZE + 1).all()
+
+    tombstones_query = db.query(DeletedItem).filter(DeletedItem.deleted < listed_until)
+    if tombstone_key is not None:
+        tombstones_query = tombstones_query.filter(
+            keyset_filter([DeletedItem.deleted, DeletedItem.id], tombstone_key))
+    tombstones = tombstones_query.order_by(DeletedItem.deleted, DeletedItem.id) \
+        .limit(CHANGES_FEED_SIZE + 1).all()
+
+    has_more = len(items) > CHANGES_FEED_SIZE or len(tombstones) > CHANGES_FEED_SIZE
+    items = items[:CHANGES_FEED_SIZE]
+    tombstones = tombstones[:CHANGES_FEED_SIZE]
+    if items:
+        item_key = [items[-1].updated, items[-1].id]
+    if tombstones:
+        tombstone_key = [tombstones[-1].deleted, tombstones[-1].id]
+
+    changed = []
+    for i in items:
+        serialized = i.serialize
+        serialized['updated'] = i.updated.isoformat()
+        changed.append(serialized)
+    return jsonify(changed = changed,
+        deleted = [t.serialize for t in tombstones],
+        cursor = encode_changes_cursor(item_key, tombstone_key),
+        has_more = has_more)
+
+@data.route('/catalog/search.json')
+def search_json():
+    """Search results in json format, most relevant first.
+
+    Request arguments:
+        q:
+            Search terms.
+        page:
+            Page number, starting at 1.
+
+    The response includes next_page, which is null on the last page.
+    """
+    try:
+        terms, page = parse_search_args(request.args)
+    except ValueError:
+        abort(400)
+    items, has_next = search_page(db, terms, page, app.config['ITEMS_PER_PAGE'])
+    return jsonify(items = [i.serialize for i in items],
+        next_page = page + 1 if has_next else None)
 
 @data.route('/users.json')
 @login_required
@@ -78,23 +323,26 @@ def users_json():
 ################################################################################
 
 from urlparse import urljoin
-from flask import request
 from flask import url_for
 from werkzeug.contrib.atom import AtomFeed
 
-# Number of items to include in atom feed
-ATOM_FEED_SIZE = 5
-
 def make_external(url):
     """Convert relative URL to absolute URL."""
     return urljoin(request.url_root, url)
 
-@data.route('/recent.atom')
-def recent_atom_feed():
-    """Atom feed with recently created and updated items."""
+def render_atom_feed(feed_url):
+    """Render the atom feed.
+
+    Args:
+      feed_url: absolute URL of the feed.
+    Returns:
+      A tuple (etag, xml) for the current feed.
+    """
+    items = db.query(Item) \
+        .options(joinedload(Item.category), joinedload(Item.user)) \
+        .order_by(Item.updated.desc()).limit(app.config['ATOM_FEED_SIZE']).all()
     feed = AtomFeed('Latest Items', 
-        feed_url = request.url, url = request.url_root)
-    items = db.query(Item).order_by(Item.updated.desc()).limit(ATOM_FEED_SIZE).all()
+        feed_url = feed_url, url = request.url_root)
     for item in items:
         item_url = url_for('api.view_item', item_id = item.id)
         feed.add(title = item.name,
@@ -104,6 +352,26 @@ def recent_atom_feed():
                  url = make_external(item_url),
                  updated = item.updated,
                  published = item.created)
-    return feed.get_response()
+    etag = make_etag([(item.id, item.updated) for item in items])
+    return etag, feed.to_string()
+
+@data.route('/recent.atom')
+def recent_atom_feed():
+    """Atom feed with recently created and updated items.
+
+    The rendered feed is cached until items are created, edited or deleted.
+    The cache key is the feed URL without the query string, so requests
+    with made-up arguments share the cached feed.
+    """
+    feed_url = url_for('data.recent_atom_feed', _external = True)
+    key = make_key('items', 'atom', feed_url)
+    cached = cache.get(key)
+    if cached is None:
+        cached = render_atom_feed(feed_url)
+        cache.set(key, cached)
+    etag, xml = cached
+    # no Last-Modified: deleting the newest item makes the feed older
+    return conditional_response(etag, None,
+        lambda: Response(xml, mimetype = 'application/atom+xml'))
 
 ################################################################################
@@ -1,5 +1,7 @@
 from catalog import engine
 from catalog.models import Base
+from catalog.search import setup_search
 
 ##### create database #####
 Base.metadata.create_all(engine)
+setup_search(engine)
@@ -0,0 +1,34 @@
+from sqlalchemy import inspect
+
+from catalog import engine
+from catalog.models import Base
+from catalog.search import setup_search
+
+
+##### add missing indexes to an existing database #####
+#
+# database_setup.py only creates tables that do not exist yet, so indexes
+# added to the models later are missing from databases created before.
+# This script creates them, and leaves existing indexes alone.
+#
+# Note: the unique index on users.email fails if the table already
+# contains duplicate emails. Remove the duplicates and run it again.
+
+inspector = inspect(engine)
+existing_tables = inspector.get_table_names()
+
+for table in Base.metadata.sorted_tables:
+    if table.name not in existing_tables:
+        continue
+    existing_indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in existing_indexes:
+            continue
+        print "Creating index %s on %s" % (index.name, table.name)
+        index.create(engine)
+
+# create any tables that are still missing, with their indexes
+Base.metadata.create_all(engine)
+
+# create or update the full-text search index
+setup_search(engine)
@@ -0,0 +1,122 @@
+"""Test setup.
+
+The app reads its database URI and client secrets at import, so they are
+pointed to a temporary folder before catalog is imported. Run the tests
+from the catalog folder:
+
+    $ python -m pytest tests
+"""
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import urlparse
+
+import pytest
+
+test_folder = tempfile.mkdtemp(prefix = 'catalog-tests-')
+client_secret = os.path.join(test_folder, 'client_secret_google.json')
+with open(client_secret, 'w') as f:
+    json.dump({'web': {
+        'client_id': 'test-client',
+        'client_secret': 'test-secret',
+        'auth_uri': 'http://127.0.0.1/auth',
+        'token_uri': 'http://127.0.0.1/token',
+        'redirect_uris': ['postmessage'],
+    }}, f)
+os.environ['CATALOG_CLIENT_SECRETS'] = client_secret
+os.environ['CATALOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(test_folder, 'test.db')
+
+from catalog import app
+from catalog import db
+from catalog import engine
+from catalog.cache import cache
+from catalog.models import Base
+from catalog.search import setup_search
+from catalog.users import user_cache
+
+app.config['TESTING'] = True
+app.config['JOB_WORKERS'] = 0
+app.config['UPLOAD_FOLDER'] = os.path.join(test_folder, 'uploads')
+os.mkdir(app.config['UPLOAD_FOLDER'])
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(test_folder, ignore_errors = True)
+
+
+@pytest.fixture
+def database():
+    """Create the tables, and drop them after the test."""
+    Base.metadata.create_all(engine)
+    setup_search(engine)
+    yield db
+    db.remove()
+    with engine.begin() as connection:
+        connection.execute("DROP TABLE IF EXISTS items_fts")
+    Base.metadata.drop_all(engine)
+    cache.clear()
+    user_cache.clear()
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+
+################################################################################
+# Google stub server
+################################################################################
+
+class GoogleStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class GoogleStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Replies to each path with the next of its stub responses."""
+
+    # keep connections open, like Google does
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self):
+        path = urlparse.urlparse(self.path).path
+        self.server.requests.append(self.path)
+        self.server.client_ports.add(self.client_address[1])
+        if self.headers.get('Content-Length'):
+            self.rfile.read(int(self.headers['Content-Length']))
+        responses = self.server.responses.get(path, [(404, {})])
+        # the last response is repeated
+        status, data = responses.pop(0) if len(responses) > 1 else responses[0]
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = reply
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def google_server():
+    """Local HTTP server standing in for Google.
+
+    Set server.responses[path] to a list of (status, JSON data) replies.
+    The requested URLs (path and query) are recorded in server.requests,
+    and the client ports of the connections in server.client_ports.
+    """
+    server = GoogleStubServer(('127.0.0.1', 0), GoogleStubHandler)
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    server.responses = {}
+    server.requests = []
+    server.client_ports = set()
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,65 @@
+import json
+
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+
+from catalog import app
+from catalog.models import User, Category, Item, DeletedItem, ImageFile, Job
+
+
+def run_command(*args):
+    result = CliRunner().invoke(app.cli, list(args), obj = ScriptInfo(create_app = lambda info: app))
+    assert result.exit_code == 0, result.output
+    return result
+
+def write_items(path, *items):
+    path.write(''.join(json.dumps(dict(category_id = 1, user_id = 1, **item)) + '\n'
+        for item in items))
+
+OLD_IMAGE = 'a' * 64 + '.jpg'
+NEW_IMAGE = 'b' * 64 + '.jpg'
+
+def add_old_items(db):
+    db.add(User(id = 1, name = 'Test User', email = 'test@example.com'))
+    db.add(Category(id = 1, name = 'Category'))
+    db.add_all([Item(id = i, name = 'Old %d' % i, category_id = 1, user_id = 1, image = OLD_IMAGE)
+        for i in (1, 2, 3)])
+    db.add(ImageFile(name = OLD_IMAGE, ref_count = 3))
+    db.commit()
+
+def test_load_replace_writes_tombstones(database, tmpdir):
+    add_old_items(database)
+    items = tmpdir.join('items.jsonl')
+    write_items(items, dict(id = 4, name = 'New'))
+
+    run_command('catalog-load', '--replace', '--items', str(items))
+    database.remove()
+    assert [item.id for item in database.query(Item)] == [4]
+    tombstones = database.query(DeletedItem).order_by(DeletedItem.item_id).all()
+    assert [(t.item_id, t.category_id) for t in tombstones] == [(1, 1), (2, 1), (3, 1)]
+    assert all(t.deleted is not None for t in tombstones)
+
+def test_load_replace_keeps_reloaded_items(client, database, tmpdir, monkeypatch):
+    add_old_items(database)
+    items = tmpdir.join('items.jsonl')
+    write_items(items, dict(id = 1, name = 'Reloaded'), dict(id = 4, name = 'New'))
+
+    run_command('catalog-load', '--replace', '--items', str(items))
+    monkeypatch.setitem(app.config, 'CHANGES_FEED_DELAY', 0)
+    feed = json.loads(client.get('/catalog/changes.json').data)
+    assert sorted(item['id'] for item in feed['changed']) == [1, 4]
+    assert sorted(t['item_id'] for t in feed['deleted']) == [2, 3]
+
+def test_load_recounts_image_references(database, tmpdir):
+    add_old_items(database)
+    items = tmpdir.join('items.jsonl')
+    write_items(items,
+        dict(id = 1, name = 'Reloaded', image = NEW_IMAGE),
+        dict(id = 4, name = 'New', image = NEW_IMAGE),
+        dict(id = 5, name = 'Legacy', image = 'legacy.jpg'))
+
+    run_command('catalog-load', '--replace', '--items', str(items))
+    database.remove()
+    assert [(f.name, f.ref_count) for f in database.query(ImageFile)] == [(NEW_IMAGE, 2)]
+    job = database.query(Job).filter_by(kind = 'delete_image').one()
+    assert json.loads(job.payload) == {'filename': OLD_IMAGE}
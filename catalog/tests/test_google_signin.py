@@ -0,0 +1,106 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from catalog import app
+from catalog.google_signin import oauth_flow, revoke_token_later, revocation_counts
+from catalog.jobs import run_pending_jobs
+from catalog.models import Job, User
+
+
+def run_jobs_now(db):
+    """Run the pending jobs, including those waiting for a retry."""
+    db.query(Job).filter_by(status = 'pending') \
+        .update({'run_after': datetime.utcnow()}, synchronize_session = False)
+    db.commit()
+    run_pending_jobs()
+
+def make_id_token(claims):
+    """Make an (unsigned) JWT, which oauth2client decodes without checking."""
+    payload = base64.urlsafe_b64encode(json.dumps(claims)).rstrip('=')
+    return 'header.%s.signature' % payload
+
+@pytest.fixture
+def google(google_server, monkeypatch):
+    """Point the Google endpoints to the stub server, with a valid sign-in."""
+    url = google_server.url
+    monkeypatch.setattr(oauth_flow, 'token_uri', url + '/token')
+    monkeypatch.setitem(app.config, 'GOOGLE_TOKENINFO_URI', url + '/tokeninfo')
+    monkeypatch.setitem(app.config, 'GOOGLE_USERINFO_URI', url + '/userinfo')
+    monkeypatch.setitem(app.config, 'GOOGLE_REVOKE_URI', url + '/revoke')
+    google_server.responses.update({
+        '/token': [(200, {'access_token': 'access-token', 'expires_in': 3600,
+            'id_token': make_id_token({'sub': 'g1'})})],
+        '/tokeninfo': [(200, {'user_id': 'g1', 'audience': 'test-client',
+            'expires_in': 3600})],
+        '/userinfo': [(200, {'name': 'Test User', 'email': 'test@example.com',
+            'picture': 'http://example.com/picture.jpg'})],
+        '/revoke': [(200, {})],
+    })
+    return google_server
+
+
+def test_google_connect(client, database, google):
+    response = client.post('/google_connect', data = 'code')
+    assert response.status_code == 200
+    assert 'Welcome, Test User!' in response.data
+    user = database.query(User).filter_by(email = 'test@example.com').one()
+    with client.session_transaction() as session:
+        assert session['user_id'] == user.id
+        assert session['credentials'] == 'access-token'
+    assert google.requests == ['/token', '/tokeninfo?access_token=access-token',
+        '/userinfo?access_token=access-token&alt=json']
+
+def test_google_connect_reuses_connections(client, database, google):
+    for i in range(3):
+        assert client.post('/google_connect', data = 'code').status_code == 200
+        assert client.get('/google_disconnect').status_code == 302
+    run_jobs_now(database)
+    assert len(google.requests) == 12
+    assert len(google.client_ports) == 1
+
+def test_google_connect_invalid_code(client, database, google):
+    google.responses['/token'] = [(400, {'error': 'invalid_grant'})]
+    response = client.post('/google_connect', data = 'code')
+    assert response.status_code == 401
+    assert database.query(User).count() == 0
+
+def test_google_connect_token_of_other_user(client, database, google):
+    google.responses['/tokeninfo'] = [(200, {'user_id': 'g2', 'audience': 'test-client'})]
+    response = client.post('/google_connect', data = 'code')
+    assert response.status_code == 401
+    assert '/userinfo' not in ' '.join(google.requests)
+
+def test_google_connect_token_of_other_app(client, database, google):
+    google.responses['/tokeninfo'] = [(200, {'user_id': 'g1', 'audience': 'other-client'})]
+    response = client.post('/google_connect', data = 'code')
+    assert response.status_code == 401
+
+def test_google_disconnect(client, database, google):
+    client.post('/google_connect', data = 'code')
+    response = client.get('/google_disconnect')
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert 'user_id' not in session
+    job = database.query(Job).filter_by(kind = 'revoke_token').one()
+    assert json.loads(job.payload) == {'access_token': 'access-token'}
+
+def test_revoke_token_retries_server_errors(database, google):
+    google.responses['/revoke'] = [(503, {}), (200, {})]
+    revoked = revocation_counts['revoked']
+
+    revoke_token_later('secret-token')
+    database.commit()
+    run_jobs_now(database)
+    job = database.query(Job).filter_by(kind = 'revoke_token').one()
+    assert (job.status, job.attempts) == ('pending', 1)
+    assert 'secret-token' in job.payload
+
+    run_jobs_now(database)
+    job = database.query(Job).filter_by(kind = 'revoke_token').one()
+    assert (job.status, job.attempts) == ('done', 2)
+    assert 'secret-token' not in job.payload
+    assert google.requests == ['/revoke?token=secret-token'] * 2
+    assert revocation_counts['revoked'] == revoked + 1
@@ -0,0 +1,322 @@
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from urllib import quote
+
+from PIL import Image
+
+from sqlalchemy import event
+
+from catalog import app
+from catalog import engine
+from catalog.cache import cache, invalidate
+from catalog.images import image_path, upload_path, variant_filename
+from catalog.models import User, Category, Item, DeletedItem
+from catalog.pagination import encode_cursor
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements run by the engine in a list."""
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+def add_items(db, categories, items_per_category):
+    user = db.query(User).first()
+    if user is None:
+        user = User(name = 'Test User', email = 'test@example.com')
+        db.add(user)
+    for i in range(categories):
+        category = Category(name = 'Category %d' % db.query(Category).count())
+        db.add(category)
+        for j in range(items_per_category):
+            db.add(Item(name = 'Item %d' % j, description = 'Description',
+                category = category, user = user))
+    db.commit()
+
+
+def test_homepage_query_count(client, database):
+    add_items(database, 1, 1)
+    # the first requests run start-up hooks and load the category cache
+    client.get('/')
+    with count_queries() as few_items:
+        assert client.get('/').status_code == 200
+
+    add_items(database, 5, 20)
+    client.get('/')
+    with count_queries() as many_items:
+        response = client.get('/')
+    assert response.status_code == 200
+    assert 'Category 5' in response.data
+    assert len(few_items) == len(many_items) == 3
+
+
+def make_image(color):
+    data = StringIO()
+    Image.new('RGB', (40, 30), color).save(data, 'PNG')
+    return data.getvalue()
+
+def log_in(client, db):
+    add_items(db, 1, 0)
+    user = db.query(User).first()
+    with client.session_transaction() as session:
+        session['username'] = user.name
+        session['user_id'] = user.id
+    response = client.get('/catalog/item/new/')
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.data).group(1)
+
+def test_new_item_file_wins_over_earlier_upload(client, database):
+    csrf_token = log_in(client, database)
+    headers = {'X-CSRF-Token': csrf_token}
+    upload = json.loads(client.post('/image/uploads/', headers = headers).data)
+    url = '/image/uploads/%s/' % upload['id']
+    client.patch(url, data = make_image('red'), headers = dict(headers, **{'Upload-Offset': '0'}))
+    uploaded_image = json.loads(client.post(url + 'finalize/', headers = headers).data)['image']
+
+    # the form failed validation, and the user chose another file
+    response = client.post('/catalog/item/new/', data = {
+        'csrf_token': csrf_token,
+        'name': 'New item',
+        'description': 'Description',
+        'category_id': database.query(Category.id).scalar(),
+        'image_upload': upload['id'],
+        'image': (StringIO(make_image('blue')), 'blue.png'),
+    })
+    assert response.status_code == 302
+    item = database.query(Item).filter_by(name = 'New item').one()
+    assert item.image is not None
+    assert item.image != uploaded_image
+
+def test_changes_feed_waits_for_late_commits(client, database, monkeypatch):
+    add_items(database, 1, 2)
+    old, new = database.query(Item).order_by(Item.id).all()
+    old.updated = datetime.utcnow() - timedelta(minutes = 5)
+    database.add(DeletedItem(item_id = 100, category_id = new.category_id))
+    database.commit()
+    old_id, new_id, new_updated = old.id, new.id, new.updated
+    category_id, user_id = new.category_id, new.user_id
+
+    # changes younger than CHANGES_FEED_DELAY are not listed yet
+    feed = json.loads(client.get('/catalog/changes.json').data)
+    assert [item['id'] for item in feed['changed']] == [old_id]
+    assert feed['deleted'] == []
+
+    # a transaction commits a change dated before the newest change
+    late = Item(name = 'Late', description = 'Description', category_id = category_id,
+        user_id = user_id, updated = new_updated - timedelta(seconds = 1))
+    database.add(late)
+    database.commit()
+    late_id = late.id
+
+    monkeypatch.setitem(app.config, 'CHANGES_FEED_DELAY', 0)
+    feed = json.loads(client.get('/catalog/changes.json?cursor=' + feed['cursor']).data)
+    assert [item['id'] for item in feed['changed']] == [late_id, new_id]
+    assert [t['item_id'] for t in feed['deleted']] == [100]
+
+def test_view_image_stats_file_once(client, database, monkeypatch):
+    name = 'ab' * 32 + '.jpg'
+    for filename in (name, variant_filename(name, 'thumb')):
+        path = image_path(filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(make_image('red'))
+    stats = []
+    for function in ('stat', 'fstat'):
+        def counted(arg, function = getattr(os, function)):
+            stats.append(arg)
+            return function(arg)
+        monkeypatch.setattr(os, function, counted)
+
+    response = client.get('/image/thumb/%s/' % name)
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert len(stats) == 1
+
+    # no variant yet: the original is served, and may still change
+    response = client.get('/image/medium/%s/' % name)
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+    assert client.get('/image/thumb/%s/' % ('cd' * 32 + '.jpg')).status_code == 404
+
+def test_atom_feed_cache_ignores_query_string(client, database):
+    add_items(database, 1, 2)
+    response = client.get('/recent.atom')
+    assert response.status_code == 200
+    assert '<link href="http://localhost/recent.atom" rel="self" />' in response.data
+    cached = len(cache._cache)
+    for i in range(5):
+        response = client.get('/recent.atom?x=%d' % i)
+        assert '<link href="http://localhost/recent.atom" rel="self" />' in response.data
+    assert len(cache._cache) == cached
+
+def test_cursors_must_match_column_types(client, database):
+    add_items(database, 1, 3)
+    category_id = database.query(Category.id).scalar()
+    url = '/catalog/category/%d/?after=' % category_id
+    assert client.get(url + encode_cursor([u'Item 0', 1])).status_code == 200
+    assert client.get(url + encode_cursor([u'x', u'y'])).status_code == 400
+    assert client.get(url + encode_cursor([1, 1])).status_code == 400
+    assert client.get(url + encode_cursor([u'x', True])).status_code == 400
+    assert client.get('/api/items?cursor=' + encode_cursor([1])).status_code == 200
+    assert client.get('/api/items?cursor=' + encode_cursor([u'y'])).status_code == 400
+    assert client.get('/api/items?cursor=' + encode_cursor([1.5])).status_code == 400
+
+def test_collections_are_modified_by_deletes(client, database):
+    add_items(database, 1, 2)
+    category_id = database.query(Category.id).scalar()
+    urls = ['/catalog/category/%d/' % category_id,
+        '/catalog/category-%d.json' % category_id, '/recent.atom']
+    responses = [client.get(url) for url in urls]
+    for response in responses:
+        assert response.status_code == 200
+        assert response.last_modified is None
+
+    item = database.query(Item).order_by(Item.updated.desc()).first()
+    database.delete(item)
+    database.commit()
+    invalidate('items')
+    for url, response in zip(urls, responses):
+        headers = {'If-Modified-Since': 'Sat, 01 Jan 2050 00:00:00 GMT'}
+        assert client.get(url, headers = headers).status_code == 200
+        headers = {'If-None-Match': response.headers['ETag']}
+        assert client.get(url, headers = headers).status_code == 200
+
+def add_search_items(db):
+    add_items(db, 1, 0)
+    category, user = db.query(Category).one(), db.query(User).one()
+    items = [Item(name = name, description = description, category = category, user = user)
+        for name, description in [
+            ('Stand', 'A stand for a guitar'),
+            ('Guitar', 'Six strings of wood'),
+            ('Piano', 'Eighty eight keys'),
+        ]]
+    db.add_all(items)
+    db.commit()
+    return [item.id for item in items]
+
+def search_json(client, query):
+    response = client.get('/catalog/search.json?' + query)
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+def test_search_ranks_name_matches_first(client, database):
+    stand, guitar, piano = add_search_items(database)
+    results = search_json(client, 'q=guitar')
+    assert [item['id'] for item in results['items']] == [guitar, stand]
+    assert results['next_page'] is None
+
+    response = client.get('/catalog/search/?q=guitar')
+    assert response.status_code == 200
+    assert response.data.index('Guitar') < response.data.index('Stand')
+    assert 'Piano' not in response.data
+
+def test_search_pages(client, database, monkeypatch):
+    stand, guitar, piano = add_search_items(database)
+    monkeypatch.setitem(app.config, 'ITEMS_PER_PAGE', 1)
+    results = search_json(client, 'q=guitar')
+    assert ([item['id'] for item in results['items']], results['next_page']) == ([guitar], 2)
+    results = search_json(client, 'q=guitar&page=2')
+    assert ([item['id'] for item in results['items']], results['next_page']) == ([stand], None)
+    assert search_json(client, 'q=guitar&page=3')['items'] == []
+    for url in ('/catalog/search.json', '/catalog/search/'):
+        for page in ('0', '-1', 'x'):
+            assert client.get(url + '?q=guitar&page=' + page).status_code == 400
+
+def test_search_ignores_fts_operators(client, database):
+    stand, guitar, piano = add_search_items(database)
+    for terms in ['"', 'a*', 'guita*', '*', '(', 'NEAR(guitar', 'guitar OR piano',
+            'NOT guitar', '-guitar', 'name:piano', '^guitar', 'guitar"']:
+        query = 'q=' + quote(terms)
+        search_json(client, query)
+        assert client.get('/catalog/search/?' + query).status_code == 200
+    assert search_json(client, 'q=' + quote('guitar"'))['items'] == \
+        search_json(client, 'q=guitar')['items']
+    assert search_json(client, 'q=' + quote('guitar OR piano'))['items'] == []
+
+def test_search_index_follows_edits_and_deletes(client, database):
+    stand, guitar, piano = add_search_items(database)
+    database.query(Item).filter_by(id = piano) \
+        .update({'name': 'Bass', 'description': 'Four strings'})
+    database.query(Item).filter_by(id = stand).delete()
+    database.commit()
+    assert search_json(client, 'q=piano')['items'] == []
+    assert [item['id'] for item in search_json(client, 'q=bass')['items']] == [piano]
+    assert sorted(item['id'] for item in search_json(client, 'q=strings')['items']) == \
+        sorted([guitar, piano])
+    assert [item['id'] for item in search_json(client, 'q=guitar')['items']] == [guitar]
+
+def start_upload(client, db):
+    headers = {'X-CSRF-Token': log_in(client, db)}
+    upload = json.loads(client.post('/image/uploads/', headers = headers).data)
+    return '/image/uploads/%s/' % upload['id'], upload['id'], headers
+
+def patch_upload(client, url, headers, offset, data, **kwargs):
+    return client.patch(url, data = data, headers = dict(headers, **{'Upload-Offset': str(offset)}), **kwargs)
+
+def test_upload_rejects_wrong_offset(client, database):
+    url, upload_id, headers = start_upload(client, database)
+    data = make_image('red')
+    assert patch_upload(client, url, headers, 0, data[:10]).status_code == 200
+    for offset in (0, 5, 20):
+        response = patch_upload(client, url, headers, offset, data[10:])
+        assert response.status_code == 409
+        assert response.headers['Upload-Offset'] == '10'
+        assert json.loads(response.data)['offset'] == 10
+    assert os.path.getsize(upload_path(upload_id)) == 10
+
+def test_upload_resumes_after_short_body(client, database):
+    url, upload_id, headers = start_upload(client, database)
+    data = make_image('red')
+    # the connection drops after 10 of the announced bytes
+    patch_upload(client, url, headers, 0, None, input_stream = StringIO(data[:10]),
+        content_length = len(data))
+    response = client.get(url, headers = headers)
+    assert json.loads(response.data)['offset'] == 10
+    assert response.headers['Upload-Offset'] == '10'
+
+    response = patch_upload(client, url, headers, 10, data[10:])
+    assert json.loads(response.data)['offset'] == len(data)
+    response = client.post(url + 'finalize/', headers = headers)
+    assert response.status_code == 200
+    with open(image_path(json.loads(response.data)['image']), 'rb') as f:
+        assert f.read() == data
+
+def test_upload_size_is_limited(client, database, monkeypatch):
+    url, upload_id, headers = start_upload(client, database)
+    data = make_image('red')
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', len(data) - 1)
+    assert patch_upload(client, url, headers, 0, data[:10]).status_code == 200
+    assert patch_upload(client, url, headers, 10, data[10:]).status_code == 413
+    assert patch_upload(client, url, headers, 10, data[10:-1]).status_code == 200
+
+def test_upload_of_non_image_is_discarded(client, database):
+    url, upload_id, headers = start_upload(client, database)
+    assert patch_upload(client, url, headers, 0, 'not an image').status_code == 200
+    assert os.path.exists(upload_path(upload_id))
+    assert client.post(url + 'finalize/', headers = headers).status_code == 400
+    assert not os.path.exists(upload_path(upload_id))
+    assert client.get(url, headers = headers).status_code == 404
+
+def test_upload_of_other_user_is_not_found(client, database):
+    url, upload_id, headers = start_upload(client, database)
+    assert patch_upload(client, url, headers, 0, 'data').status_code == 200
+    other = User(name = 'Other', email = 'other@example.com')
+    database.add(other)
+    database.commit()
+    with client.session_transaction() as session:
+        session['username'] = other.name
+        session['user_id'] = other.id
+    assert client.get(url, headers = headers).status_code == 404
+    assert patch_upload(client, url, headers, 4, 'more').status_code == 404
+    assert client.post(url + 'finalize/', headers = headers).status_code == 404
+    assert os.path.getsize(upload_path(upload_id)) == 4
@@ -12,6 +12,7 @@ pip install itsdangerous
 pip install flask-httpauth
 pip install Flask-WTF
 pip install Flask-SQLAlchemy
+pip install Pillow
 su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb catalog'